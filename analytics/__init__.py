@@ -0,0 +1,7 @@
+from analytics.latency import LatencyHistogram, ReplyLatencies, thread_reply_latencies, roll_up_reply_latencies
+from analytics.sessions import SESSION_DTYPE, message_arrays, segment_sessions, roll_up_sessions
+from analytics.cube import GROUP_CHATS, AggregateCube
+from analytics.sampling import margin_of_error
+from analytics.ranking import RankingIndex
+from analytics.suggest import CategorySuggester, activity_fingerprints
+from analytics.outofcore import SpillingCounter, streamed_cube
@@ -0,0 +1,183 @@
+import numpy
+
+from analytics.ranking import RankingIndex
+from wxparser import Message, _aware_time_to_milliseconds
+
+
+GROUP_CHATS = 'group-chats'
+
+# Weekday (Monday is 0) of 1970-01-01, for weekdays of days since the epoch
+EPOCH_WEEKDAY = 3
+
+# Message.TYPE_* run from 1, so this leaves room for every one of them
+TYPE_COUNT = max(value for name, value in vars(Message).items() if name.startswith('TYPE_')) + 1
+
+
+class AggregateCube(object):
+    """Message counts over a period, materialized once as a dense array.
+
+    Every thread with messages in the period gets a row indexed by
+    (month, weekday, hour_bucket, sent, type), bucketed in the timezone of
+    `start`. Rows are also summed per category (individual threads by
+    category slug or 'other', group chats under 'group-chats'), so roll-ups
+    by category never touch the thread rows. Recategorizing a thread only
+    moves its row from one category total to another.
+
+    When the threads were read from a sample of messages, pass its
+    `sample_rate` and every count comes back scaled up to an estimate.
+    """
+
+    AXES = ('month', 'weekday', 'hour_bucket', 'sent', 'type')
+    HOUR_BUCKET_HOURS = 4
+    TYPE_COUNT = TYPE_COUNT
+
+    # Thread rows are read this many at a time, so a disk-backed
+    # `thread_cube` is never copied into memory whole
+    BLOCK_ROWS = 64
+
+    # Distinct (day, minute) points of sent messages by category slug,
+    # when whoever built the cube collected them (see analytics.outofcore)
+    sent_minutes = None
+
+    def __init__(self, threads, start, end, sample_rate=None, thread_cube=None, counted_threads=None):
+        self.start = start
+        self.end = end
+        self.sample_rate = sample_rate
+        self.shape = self.shape_for(start, end)
+        self.months = self.shape[0]
+        # Including threads with no messages in the period, which rankings list last
+        self.all_threads = list(threads)
+        self.rankings = {}
+
+        if thread_cube is not None:
+            # Rows counted elsewhere, one per thread in `counted_threads`
+            self.threads = list(counted_threads)
+            self.thread_rows = dict((thread, row) for row, thread in enumerate(self.threads))
+            self.thread_cube = thread_cube
+        else:
+            start_milliseconds = _aware_time_to_milliseconds(start)
+            end_milliseconds = _aware_time_to_milliseconds(end)
+            self.threads = [thread for thread in threads if any(start_milliseconds <= message.create_time < end_milliseconds for message in thread.messages)]
+            self.thread_rows = dict((thread, row) for row, thread in enumerate(self.threads))
+            # Allocated once and filled in place; per-cell counts of one
+            # thread in one period fit an int32
+            self.thread_cube = numpy.zeros((len(self.threads),) + self.shape, dtype=numpy.int32)
+            for row, thread in enumerate(self.threads):
+                self._count_messages(thread.messages, self.thread_cube[row])
+
+        self.category_slugs = []
+        self.category_cube = numpy.zeros((0,) + self.shape, dtype=numpy.int64)
+        self.thread_category_codes = numpy.array([self._category_code(thread) for thread in self.threads], dtype=numpy.int32)
+        for first_row in xrange(0, len(self.threads), self.BLOCK_ROWS):
+            block = self.thread_cube[first_row:first_row + self.BLOCK_ROWS]
+            block_codes = self.thread_category_codes[first_row:first_row + self.BLOCK_ROWS]
+            for code in numpy.unique(block_codes):
+                self.category_cube[code] += block[block_codes == code].sum(axis=0)
+
+    @classmethod
+    def shape_for(cls, start, end):
+        months = (end.year - start.year) * 12 + end.month - start.month
+        return (months, 7, 24 // cls.HOUR_BUCKET_HOURS, 2, cls.TYPE_COUNT)
+
+    def _count_messages(self, messages, row):
+        create_times = numpy.fromiter((message.create_time for message in messages), dtype=numpy.int64, count=len(messages))
+        in_period = (create_times >= _aware_time_to_milliseconds(self.start)) & (create_times < _aware_time_to_milliseconds(self.end))
+        sent = numpy.fromiter((message.sent for message in messages), dtype=numpy.int8, count=len(messages))[in_period]
+        types = numpy.fromiter((message.type for message in messages), dtype=numpy.int8, count=len(messages))[in_period]
+        cells = period_cells(self.start, self.shape, create_times[in_period], sent, types)
+        row.reshape(-1)[:] = numpy.bincount(cells, minlength=row.size)
+
+    def _category_code(self, thread):
+        slug = category_slug(thread)
+        if slug not in self.category_slugs:
+            self.category_slugs.append(slug)
+            self.category_cube = numpy.concatenate((self.category_cube, numpy.zeros((1,) + self.shape, dtype=numpy.int64)))
+        return self.category_slugs.index(slug)
+
+    def recategorize(self, thread):
+        if thread not in self.thread_rows:
+            return
+        row = self.thread_rows[thread]
+        old_code = self.thread_category_codes[row]
+        new_code = self._category_code(thread)
+        self.category_cube[old_code] -= self.thread_cube[row]
+        self.category_cube[new_code] += self.thread_cube[row]
+        self.thread_category_codes[row] = new_code
+
+    def counts(self, by=(), sent=None, types=None, threads=None, months=None):
+        """Sum over every axis not named in `by`, returning the `by` axes in order.
+
+        `by` may start with 'category' (indexed like `category_slugs`) or
+        'thread' (indexed like `threads`, or like the active threads of the
+        `threads` argument when given). `sent`, `types` and `months` restrict
+        the sent, type and month axes.
+        """
+        if threads is None and 'thread' not in by:
+            return self._scale(self._reduce(self.category_cube, ('category',) + self.AXES, by, sent, types, months))
+
+        axes = ('thread',) + self.AXES
+        if threads is not None:
+            rows = [self.thread_rows[thread] for thread in threads if thread in self.thread_rows]
+            blocks = [self.thread_cube[rows[i:i + self.BLOCK_ROWS]] for i in xrange(0, len(rows), self.BLOCK_ROWS)]
+        else:
+            blocks = (self.thread_cube[i:i + self.BLOCK_ROWS] for i in xrange(0, len(self.threads), self.BLOCK_ROWS))
+        summed = [self._reduce(block, axes, by, sent, types, months) for block in blocks]
+        if not summed:
+            return self._scale(self._reduce(self.thread_cube[:0], axes, by, sent, types, months))
+        if 'thread' in by:
+            return self._scale(numpy.concatenate(summed, axis=list(by).index('thread')))
+        return self._scale(sum(summed[1:], summed[0]))
+
+    def _reduce(self, cube, axes, by, sent, types, months):
+        if months is not None:
+            cube = cube.take(list(months), axis=axes.index('month'))
+        if sent is not None:
+            cube = cube.take([1 if sent else 0], axis=axes.index('sent'))
+        if types is not None:
+            cube = cube.take(list(types), axis=axes.index('type'))
+
+        summed = cube.sum(axis=tuple(i for i, axis in enumerate(axes) if axis not in by))
+        kept_axes = [axis for axis in axes if axis in by]
+        return summed.transpose([kept_axes.index(axis) for axis in by])
+
+    def _scale(self, summed):
+        if self.sample_rate is not None:
+            return numpy.rint(summed / self.sample_rate).astype(numpy.int64)
+        return summed
+
+    def thread_counts(self, threads, sent=None, types=None, months=None):
+        """Per-thread totals for `threads`, zero for threads with no messages in the period."""
+        active_threads = [thread for thread in threads if thread in self.thread_rows]
+        totals = dict(zip(active_threads, self.counts(('thread',), sent=sent, types=types, threads=active_threads, months=months)))
+        return [int(totals[thread]) if thread in totals else 0 for thread in threads]
+
+    def ranking(self, sent=None, types=None, months=None, group_chats=None):
+        """RankingIndex of every thread (only group chats, or only individual
+        threads, when `group_chats` is given) by its count under the same
+        filters as `counts`. Built once per combination of filters; counts
+        per thread never change, so neither does the index.
+        """
+        key = (sent, tuple(types) if types is not None else None, tuple(months) if months is not None else None, group_chats)
+        if key not in self.rankings:
+            threads = self.all_threads if group_chats is None else [thread for thread in self.all_threads if thread.is_group_chat == group_chats]
+            self.rankings[key] = RankingIndex(threads, self.thread_counts(threads, sent, types, months))
+        return self.rankings[key]
+
+
+def period_cells(start, shape, create_times, sent, types):
+    """Flat cube cell of each message, for messages already known to fall in
+    the period that begins at `start` and has cube shape `shape`.
+    """
+    local_seconds = create_times // 1000 + int(start.utcoffset().total_seconds())
+    local_days = local_seconds // (60 * 60 * 24)
+    months = local_days.astype('datetime64[D]').astype('datetime64[M]').astype(numpy.int64) - ((start.year - 1970) * 12 + start.month - 1)
+    weekdays = (local_days + EPOCH_WEEKDAY) % 7
+    hour_buckets = local_seconds % (60 * 60 * 24) // (60 * 60 * AggregateCube.HOUR_BUCKET_HOURS)
+    return numpy.ravel_multi_index((months, weekdays, hour_buckets, sent, types), shape)
+
+
+def category_slug(thread):
+    if thread.is_group_chat:
+        return GROUP_CHATS
+    category = getattr(thread, 'category', None)
+    return category.slug if category else 'other'
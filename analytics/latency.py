@@ -0,0 +1,95 @@
+import math
+
+import numpy
+
+from analytics.cube import category_slug
+
+
+class LatencyHistogram(object):
+    """Log-bucketed histogram of durations in seconds.
+
+    Each power of two is split into SUBBUCKETS buckets, so quantiles come
+    back within ~10% of the true value. Histograms of the same shape merge by
+    adding bucket counts, which is what lets per-thread results roll up into
+    per-category ones without revisiting any messages.
+    """
+
+    SUBBUCKETS = 8
+    BUCKET_COUNT = 28 * SUBBUCKETS  # 2^28 seconds is ~8.5 years
+
+    def __init__(self):
+        self.buckets = [0] * self.BUCKET_COUNT
+        self.count = 0
+        self.total_seconds = 0.0
+
+    def add(self, seconds):
+        bucket = int(math.log(seconds + 1, 2) * self.SUBBUCKETS)
+        self.buckets[min(bucket, self.BUCKET_COUNT - 1)] += 1
+        self.count += 1
+        self.total_seconds += seconds
+
+    def merge(self, other):
+        for i in xrange(0, self.BUCKET_COUNT):
+            self.buckets[i] += other.buckets[i]
+        self.count += other.count
+        self.total_seconds += other.total_seconds
+        return self
+
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        target = q * self.count
+        cumulative = 0
+        for i in xrange(0, self.BUCKET_COUNT):
+            cumulative += self.buckets[i]
+            if cumulative >= target and self.buckets[i]:
+                return 2 ** ((i + 0.5) / self.SUBBUCKETS) - 1
+
+    @property
+    def median(self):
+        return self.quantile(0.5)
+
+    @property
+    def mean(self):
+        return self.total_seconds / self.count if self.count else None
+
+
+class ReplyLatencies(object):
+
+    def __init__(self):
+        self.mine = LatencyHistogram()
+        self.theirs = LatencyHistogram()
+
+    def merge(self, other):
+        self.mine.merge(other.mine)
+        self.theirs.merge(other.theirs)
+        return self
+
+
+def thread_reply_latencies(create_times, sent, reply_window=None):
+    """Time every change of turn in a thread's time-ordered createTime and
+    isSend arrays.
+
+    A reply's latency is measured from the last message of the other side's
+    turn. Turn changes further apart than `reply_window` (a timedelta) start a
+    new conversation and are not counted as replies.
+    """
+    latencies = ReplyLatencies()
+    replies = numpy.flatnonzero(sent[1:] != sent[:-1]) + 1
+    seconds = (create_times[replies] - create_times[replies - 1]) / 1000.0
+    if reply_window:
+        in_window = seconds <= reply_window.total_seconds()
+        replies, seconds = replies[in_window], seconds[in_window]
+    for mine, reply_seconds in zip(sent[replies], seconds):
+        (latencies.mine if mine else latencies.theirs).add(float(reply_seconds))
+    return latencies
+
+
+def roll_up_reply_latencies(by_thread):
+    """Merge per-thread ReplyLatencies into one per category slug, by each
+    thread's category at the time of the call.
+    """
+    by_category = {}
+    for thread, latencies in by_thread.items():
+        by_category.setdefault(category_slug(thread), ReplyLatencies()).merge(latencies)
+    return by_category
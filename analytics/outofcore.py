@@ -0,0 +1,214 @@
+import itertools
+import os
+import shutil
+import tempfile
+
+import numpy
+
+from analytics.cube import AggregateCube, category_slug, period_cells
+from wxparser import _aware_time_to_milliseconds
+
+
+class SpillingCounter(object):
+    """Sums counts per integer key within a memory budget (in bytes).
+
+    Added keys are buffered; a full buffer is collapsed into a sorted run
+    of distinct keys and written to a temporary file. `blocks` merges the
+    runs back into one sorted stream, at most MERGE_FAN_IN runs at a time,
+    so memory stays flat however many runs there are.
+    """
+
+    ENTRY_BYTES = 16  # an int64 key and an int64 count
+    MERGE_FAN_IN = 16
+
+    def __init__(self, memory_budget):
+        # The buffer, its collapsed copy and the sort's scratch space all
+        # have to fit at once
+        self.buffer_entries = max(1024, memory_budget // (self.ENTRY_BYTES * 4))
+        self.directory = tempfile.mkdtemp(prefix='westats-')
+        self.runs = []
+        self.run_numbers = itertools.count()
+        self.buffered_keys = []
+        self.buffered_counts = []
+        self.buffered = 0
+
+    def add(self, keys, counts=None):
+        if counts is None:
+            counts = numpy.ones(len(keys), dtype=numpy.int64)
+        self.buffered_keys.append(numpy.asarray(keys, dtype=numpy.int64))
+        self.buffered_counts.append(numpy.asarray(counts, dtype=numpy.int64))
+        self.buffered += len(keys)
+        if self.buffered >= self.buffer_entries:
+            self._spill()
+
+    def _spill(self):
+        if not self.buffered:
+            return
+        run = _collapse(numpy.concatenate(self.buffered_keys), numpy.concatenate(self.buffered_counts))
+        self.buffered_keys = []
+        self.buffered_counts = []
+        self.buffered = 0
+        self._write_run([run])
+
+    def _write_run(self, blocks):
+        run_number = next(self.run_numbers)
+        keys_path = os.path.join(self.directory, '%d.keys' % run_number)
+        counts_path = os.path.join(self.directory, '%d.counts' % run_number)
+        length = 0
+        keys_file = open(keys_path, 'wb')
+        counts_file = open(counts_path, 'wb')
+        for keys, counts in blocks:
+            keys.tofile(keys_file)
+            counts.tofile(counts_file)
+            length += len(keys)
+        keys_file.close()
+        counts_file.close()
+        if length:
+            self.runs.append((keys_path, counts_path, length))
+        else:
+            _remove_run((keys_path, counts_path, length))
+
+    def _read_run(self, run, block_entries):
+        keys_path, counts_path, length = run
+        keys = numpy.memmap(keys_path, dtype=numpy.int64, mode='r', shape=(length,))
+        counts = numpy.memmap(counts_path, dtype=numpy.int64, mode='r', shape=(length,))
+        for i in xrange(0, length, block_entries):
+            yield numpy.array(keys[i:i + block_entries]), numpy.array(counts[i:i + block_entries])
+
+    def _merge(self, runs):
+        block_entries = max(1024, self.buffer_entries // (len(runs) or 1))
+        return _merge_sorted_blocks([self._read_run(run, block_entries) for run in runs])
+
+    def blocks(self):
+        """Yield (keys, counts) arrays in ascending key order, each distinct key exactly once."""
+        self._spill()
+        while len(self.runs) > self.MERGE_FAN_IN:
+            merging = self.runs[:self.MERGE_FAN_IN]
+            self.runs = self.runs[self.MERGE_FAN_IN:]
+            self._write_run(self._merge(merging))
+            for run in merging:
+                _remove_run(run)
+        return self._merge(self.runs)
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def _collapse(keys, counts):
+    if not len(keys):
+        return keys, counts
+    order = numpy.argsort(keys, kind='mergesort')
+    keys = keys[order]
+    starts = numpy.flatnonzero(numpy.concatenate(([True], keys[1:] != keys[:-1])))
+    return keys[starts], numpy.add.reduceat(counts[order], starts)
+
+
+def _merge_sorted_blocks(streams):
+    # Each stream yields sorted blocks. Every key up to the smallest last key
+    # among the blocks in hand is complete, since no stream can yield it again.
+    heads = []
+    for stream in streams:
+        block = next(stream, None)
+        if block is not None:
+            heads.append([block, stream])
+    while heads:
+        boundary = min(block[0][-1] for block, _ in heads)
+        ready_keys = []
+        ready_counts = []
+        remaining = []
+        for head in heads:
+            keys, counts = head[0]
+            split = numpy.searchsorted(keys, boundary, side='right')
+            ready_keys.append(keys[:split])
+            ready_counts.append(counts[:split])
+            head[0] = (keys[split:], counts[split:])
+            while not len(head[0][0]):
+                head[0] = next(head[1], None)
+                if head[0] is None:
+                    break
+            if head[0] is not None:
+                remaining.append(head)
+        heads = remaining
+        yield _collapse(numpy.concatenate(ready_keys), numpy.concatenate(ready_counts))
+
+
+def _remove_run(run):
+    for path in run[:2]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def streamed_cube(parser, start, end, memory_budget, chunk_rows=50000):
+    """Build an AggregateCube for `parser`'s threads without loading any
+    thread's messages, for databases too large to hold in memory.
+
+    Message rows are streamed in chunks of `chunk_rows` and folded into
+    per-(thread, cell) counts, which spill to temporary files beyond
+    `memory_budget` bytes. The thread rows end up in a temporary file too,
+    mapped into memory, and the cube only ever reads them in blocks. The
+    distinct minutes at which messages were sent, per category, are kept
+    as the cube's `sent_minutes` for the scatterplot.
+    """
+    shape = AggregateCube.shape_for(start, end)
+    cells_per_row = int(numpy.prod(shape))
+    minutes_in_period = (_aware_time_to_milliseconds(end) - _aware_time_to_milliseconds(start)) // (1000 * 60)
+    start_milliseconds = _aware_time_to_milliseconds(start)
+
+    threads = parser.threads
+    thread_codes = dict((thread.contact.raw_username, code) for code, thread in enumerate(threads))
+    slugs = []
+    for thread in threads:
+        if category_slug(thread) not in slugs:
+            slugs.append(category_slug(thread))
+    thread_slug_codes = numpy.array([slugs.index(category_slug(thread)) for thread in threads], dtype=numpy.int64)
+    active = numpy.zeros(len(threads), dtype=bool)
+
+    cell_counts = SpillingCounter(memory_budget // 2)
+    sent_points = SpillingCounter(memory_budget // 2)
+    try:
+        rows = parser.all_message_rows(start, end)
+        while True:
+            chunk = list(itertools.islice(rows, chunk_rows))
+            if not chunk:
+                break
+            codes = numpy.fromiter((thread_codes.get(row['talker'], -1) for row in chunk), dtype=numpy.int64, count=len(chunk))
+            create_times = numpy.fromiter((row['createTime'] for row in chunk), dtype=numpy.int64, count=len(chunk))
+            sent = numpy.fromiter((1 if row['isSend'] else 0 for row in chunk), dtype=numpy.int8, count=len(chunk))
+            raw_types, type_indexes = numpy.unique(numpy.fromiter((row['type'] for row in chunk), dtype=numpy.int64, count=len(chunk)), return_inverse=True)
+            decoded_types = numpy.array([parser.message_types.decode(int(raw_type)) or 0 for raw_type in raw_types], dtype=numpy.int8)
+            types = decoded_types[type_indexes]
+
+            # Threads only exist for contacts, and unknown types are skipped
+            keep = (codes >= 0) & (types > 0)
+            codes, create_times, sent, types = codes[keep], create_times[keep], sent[keep], types[keep]
+            active[codes] = True
+            cell_counts.add(codes * cells_per_row + period_cells(start, shape, create_times, sent, types))
+
+            minutes = (create_times[sent == 1] - start_milliseconds) // (1000 * 60)
+            sent_points.add(thread_slug_codes[codes[sent == 1]] * minutes_in_period + minutes)
+
+        active_codes = numpy.flatnonzero(active)
+        rows_by_code = numpy.zeros(len(threads), dtype=numpy.int64)
+        rows_by_code[active_codes] = numpy.arange(len(active_codes))
+        if len(active_codes):
+            # Per-cell counts of one thread in one period fit an int32
+            thread_cube = numpy.memmap(tempfile.TemporaryFile(prefix='westats-'), dtype=numpy.int32, mode='w+', shape=(len(active_codes),) + shape)
+            flat_thread_cube = thread_cube.reshape(-1)
+            for keys, counts in cell_counts.blocks():
+                flat_thread_cube[rows_by_code[keys // cells_per_row] * cells_per_row + keys % cells_per_row] = counts
+            thread_cube.flush()
+        else:
+            thread_cube = numpy.zeros((0,) + shape, dtype=numpy.int32)
+
+        sent_minutes = dict((slug, []) for slug in slugs)
+        for keys, _ in sent_points.blocks():
+            for slug_code in numpy.unique(keys // minutes_in_period):
+                sent_minutes[slugs[slug_code]].append(keys[keys // minutes_in_period == slug_code] % minutes_in_period)
+    finally:
+        cell_counts.close()
+        sent_points.close()
+
+    cube = AggregateCube(threads, start, end, parser.sample_rate, thread_cube=thread_cube, counted_threads=[threads[code] for code in active_codes])
+    cube.sent_minutes = dict((slug, numpy.concatenate(minutes) if minutes else numpy.zeros(0, dtype=numpy.int64))
+                             for slug, minutes in sent_minutes.items())
+    return cube
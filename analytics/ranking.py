@@ -0,0 +1,54 @@
+import heapq
+
+
+class RankingIndex(object):
+    """Threads ranked by a count, for top-K and cumulative-share queries.
+
+    The counts are heapified once, in linear time. Queries pop from the heap
+    only as far down the ranking as they need to go, and every popped entry
+    is kept along with the running total up to it. A top 10 of thousands of
+    contacts therefore costs ten pops, and asking again costs nothing.
+
+    Equal counts rank the later of the `threads` first, the same order as
+    reversed(sorted(threads, key=count)).
+    """
+
+    def __init__(self, threads, counts):
+        self.counts = dict(zip(threads, counts))
+        self.total = sum(counts)
+        self._heap = [(-count, -order, thread) for order, (thread, count) in enumerate(zip(threads, counts))]
+        heapq.heapify(self._heap)
+        self._ranked = []
+        self._prefix_sums = [0]
+
+    def __len__(self):
+        return len(self.counts)
+
+    def _pop(self):
+        negative_count, _, thread = heapq.heappop(self._heap)
+        self._ranked.append((thread, -negative_count))
+        self._prefix_sums.append(self._prefix_sums[-1] - negative_count)
+
+    def descending(self):
+        """Yield (thread, count) from the highest count down, lazily."""
+        rank = 0
+        while True:
+            if rank == len(self._ranked):
+                if not self._heap:
+                    return
+                self._pop()
+            yield self._ranked[rank]
+            rank += 1
+
+    def top(self, k):
+        while len(self._ranked) < k and self._heap:
+            self._pop()
+        return self._ranked[:k]
+
+    def prefix_sum(self, k):
+        """Sum of the `k` highest counts."""
+        self.top(k)
+        return self._prefix_sums[min(k, len(self._ranked))]
+
+    def share_of_top(self, k):
+        return float(self.prefix_sum(k)) / self.total if self.total else 0.0
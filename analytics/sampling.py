@@ -0,0 +1,13 @@
+import math
+
+
+def margin_of_error(estimate, sample_rate, z=1.96):
+    """Half-width of the confidence interval (95% by default) of a count
+    estimated by scaling up a Bernoulli sample taken at `sample_rate`.
+
+    With n sampled out of N, n ~ Binomial(N, p), so the estimate n / p has
+    variance N(1 - p) / p, which we approximate with the estimate itself.
+    """
+    if not sample_rate or sample_rate >= 1:
+        return 0
+    return z * math.sqrt(estimate * (1 - sample_rate) / sample_rate)
@@ -0,0 +1,47 @@
+import numpy
+
+from analytics.cube import category_slug
+
+
+SESSION_DTYPE = numpy.dtype([
+    ('start', numpy.int64),     # createTime (ms) of the first message
+    ('end', numpy.int64),       # createTime (ms) of the last message
+    ('count', numpy.int32),     # number of messages in the session
+    ('initiated', numpy.bool_), # whether you sent the first message
+])
+
+
+def message_arrays(messages):
+    create_times = numpy.fromiter((message.create_time for message in messages), dtype=numpy.int64, count=len(messages))
+    sent = numpy.fromiter((message.sent for message in messages), dtype=numpy.bool_, count=len(messages))
+    return create_times, sent
+
+
+def segment_sessions(create_times, sent, gap):
+    """Split a thread's time-ordered createTime and isSend arrays into
+    sessions wherever two consecutive messages are more than `gap` (a
+    timedelta) apart.
+    """
+    if len(create_times) == 0:
+        return numpy.zeros(0, dtype=SESSION_DTYPE)
+
+    breaks = numpy.diff(create_times) > gap.total_seconds() * 1000
+    starts = numpy.concatenate(([0], numpy.flatnonzero(breaks) + 1))
+    ends = numpy.concatenate((starts[1:], [len(create_times)])) - 1
+
+    sessions = numpy.empty(len(starts), dtype=SESSION_DTYPE)
+    sessions['start'] = create_times[starts]
+    sessions['end'] = create_times[ends]
+    sessions['count'] = ends - starts + 1
+    sessions['initiated'] = sent[starts]
+    return sessions
+
+
+def roll_up_sessions(thread_sessions):
+    """Concatenate (thread, sessions) pairs per category slug, by each
+    thread's category at the time of the call.
+    """
+    by_category = {}
+    for thread, sessions in thread_sessions:
+        by_category.setdefault(category_slug(thread), []).append(sessions)
+    return dict((slug, numpy.concatenate(sessions)) for slug, sessions in by_category.items())
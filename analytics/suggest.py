@@ -0,0 +1,73 @@
+import numpy
+
+from analytics.cube import EPOCH_WEEKDAY, TYPE_COUNT
+
+
+HOURS_IN_WEEK = 7 * 24
+
+
+def activity_fingerprints(threads, message_selector, timezone):
+    """One row per thread: its normalized hour-of-week activity (in
+    `timezone`) followed by its normalized mix of message types.
+    """
+    offset_seconds = int(timezone.utcoffset(None).total_seconds())
+    fingerprints = numpy.zeros((len(threads), HOURS_IN_WEEK + TYPE_COUNT))
+    for row, thread in enumerate(threads):
+        messages = message_selector(thread)
+        if not messages:
+            continue
+        local_hours = (numpy.fromiter((message.create_time for message in messages), dtype=numpy.int64, count=len(messages)) // 1000 + offset_seconds) // (60 * 60)
+        hours_of_week = (local_hours + EPOCH_WEEKDAY * 24) % HOURS_IN_WEEK
+        types = numpy.fromiter((message.type for message in messages), dtype=numpy.int64, count=len(messages))
+        fingerprints[row, :HOURS_IN_WEEK] = _normalized(numpy.bincount(hours_of_week, minlength=HOURS_IN_WEEK))
+        fingerprints[row, HOURS_IN_WEEK:] = _normalized(numpy.bincount(types, minlength=TYPE_COUNT))
+    return _normalized(fingerprints)
+
+
+def _normalized(vectors):
+    norms = numpy.sqrt((vectors.astype(numpy.float64) ** 2).sum(axis=-1, keepdims=True))
+    return numpy.where(norms > 0, vectors / numpy.where(norms > 0, norms, 1), 0)
+
+
+class CategorySuggester(object):
+    """Proposes a category for a thread from the categories of the threads
+    whose activity fingerprints are most similar to it (cosine similarity).
+
+    Categories are read from the threads on every call, so suggestions
+    improve as more threads get categorized.
+    """
+
+    def __init__(self, threads, message_selector, timezone, neighbours=5):
+        self.threads = list(threads)
+        self.rows = dict((thread, row) for row, thread in enumerate(self.threads))
+        self.fingerprints = activity_fingerprints(self.threads, message_selector, timezone)
+        self.neighbours = neighbours
+
+    def suggest(self, threads):
+        """Returns {thread: (category, confidence)}. Confidence is the summed
+        similarity of the nearest neighbours in that category divided by the
+        number of neighbours, so it is only near 1.0 when all of them agree
+        and look just like the thread. Threads without any similar
+        categorized neighbour get no suggestion.
+        """
+        labelled = [thread for thread in self.threads if getattr(thread, 'category', None)]
+        threads = [thread for thread in threads if thread in self.rows]
+        if not labelled or not threads:
+            return {}
+
+        similarities = numpy.dot(self.fingerprints[[self.rows[thread] for thread in threads]],
+                                 self.fingerprints[[self.rows[thread] for thread in labelled]].T)
+        neighbours = min(self.neighbours, len(labelled))
+        nearest = numpy.argpartition(-similarities, neighbours - 1, axis=1)[:, :neighbours]
+
+        suggestions = {}
+        for i, thread in enumerate(threads):
+            votes = {}
+            for j in nearest[i]:
+                if similarities[i, j] > 0:
+                    category = labelled[j].category
+                    votes[category] = votes.get(category, 0.0) + similarities[i, j]
+            if votes:
+                category = max(votes, key=votes.get)
+                suggestions[thread] = (category, votes[category] / neighbours)
+        return suggestions
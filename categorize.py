@@ -1,57 +1,59 @@
 import re
+import sys
 
 import shortcuts
 import utils
+import westats
+from analytics import AggregateCube, CategorySuggester
 from wxparser import Parser, UserData, Category
 
 
-class FuzzyRange(object):
+def bulk_accept(userdata, suggester, threads, minimum_confidence):
+    suggestions = suggester.suggest([thread for thread in threads if not getattr(thread, 'category', None)])
+    by_category = {}
+    for thread, (category, confidence) in suggestions.items():
+        if confidence >= minimum_confidence:
+            by_category.setdefault(category, []).append(thread)
 
-    def __init__(self, start, end):
-        self.start = start
-        self.end = end
-
-    def __eq__(self, other):
-        return self.start <= other <= self.end
-
-
-def parse_arguments(generic_parser):
-    generic_parser.add_argument('threshold',
-                                metavar='THRESHOLD',
-                                type=float,
-                                nargs='?',
-                                choices=[FuzzyRange(0.0, 1.0)],
-                                default=0.85,
-                                help='threshold for portion of threads to categorize; \
-                                      threads are ordered from most to least popular, by your sent messages; \
-                                      must be between 0.0 and 1.0 (default 0.85)')
-    return generic_parser.parse_args()
+    for category in sorted(by_category.keys(), key=lambda category: category.display_name):
+        print '%s:' % category.display_name
+        by_category[category].sort(key=lambda thread: -suggestions[thread][1])
+        for thread in by_category[category]:
+            print '    %s (%d%%)' % (thread.contact.display_name, round(100 * suggestions[thread][1]))
+        print
+        if raw_input('Put these %d threads in %s? [Y/n] ' % (len(by_category[category]), category.display_name)).strip().lower() in ['', 'y', 'yes']:
+            for thread in by_category[category]:
+                category.add_thread(thread)
+        print
+    userdata.save()
 
 
-if __name__ == '__main__':
-    parser = utils.argparser_with_generic_arguments('Simple tool to help you categorize threads.')
-    args = parse_arguments(parser)
-    wxp = Parser(args.db_file_path)
+def main(args):
+    wxp = Parser(args.db_file_path, args.merge, args.sample_rate)
     userdata = UserData.initialize(wxp)
 
-    total_individual_chats = sum([len(shortcuts.MESSAGES_IN_2015(thread)) for thread in wxp.individual_threads])
-    individual_sent_messages = sum([len(shortcuts.SENT_MESSAGES_IN_2015(thread)) for thread in wxp.individual_threads])
-    group_sent_messages = sum([len(shortcuts.SENT_MESSAGES_IN_2015(thread)) for thread in wxp.group_threads])
-    total_sent_messages = individual_sent_messages + group_sent_messages
+    cube = AggregateCube(wxp.threads, shortcuts.BEGINNING_OF_2015, shortcuts.BEGINNING_OF_2016, wxp.sample_rate)
+    sent_ranking = cube.ranking(sent=True)
+    total_sent_messages = sent_ranking.total
+    individual_sent_messages = cube.ranking(sent=True, group_chats=False).total
 
     # Figure out how many people we need
     # to categorize to get to the threshold
     total_cumulative = 0
     individual_cumulative = 0
     to_categorize = []
-    for thread in list(reversed(sorted(wxp.threads, key=lambda thread: len(shortcuts.SENT_MESSAGES_IN_2015(thread))))):
+    for thread, sent_count in sent_ranking.descending():
         if not thread.is_group_chat:
-            individual_cumulative += len(shortcuts.SENT_MESSAGES_IN_2015(thread))
-        total_cumulative += len(shortcuts.SENT_MESSAGES_IN_2015(thread))
+            individual_cumulative += sent_count
+        total_cumulative += sent_count
         to_categorize.append(thread)
         if float(total_cumulative) / total_sent_messages > args.threshold and float(individual_cumulative) / individual_sent_messages > args.threshold:
             break
 
+    suggester = CategorySuggester(wxp.threads, shortcuts.MESSAGES_IN_2015, shortcuts.BEIJING_TIME)
+    if args.bulk_accept is not None:
+        bulk_accept(userdata, suggester, to_categorize, args.bulk_accept)
+
     for thread in to_categorize:
         if getattr(thread, 'category', None):
             continue
@@ -62,7 +64,16 @@ if __name__ == '__main__':
             print '%4d - %s' % (i, categories_list[i].display_name)
         print
 
+        suggestion = suggester.suggest([thread]).get(thread)
+        if suggestion:
+            print 'Suggested: %s (%d%% confident); press Enter to accept' % (suggestion[0].display_name, round(100 * suggestion[1]))
+            print
+
         user_entry = raw_input('Enter a number or name a new category: ').strip()
+        if not user_entry and suggestion:
+            suggestion[0].add_thread(thread)
+            userdata.save()
+            continue
         if re.compile('\d+').match(user_entry):
             try:
                 selected_category_index = int(user_entry)
@@ -85,3 +96,7 @@ if __name__ == '__main__':
         userdata.add_category(new_category)
         new_category.add_thread(thread)
         userdata.save()
+
+
+if __name__ == '__main__':
+    westats.main(['categorize'] + sys.argv[1:])
@@ -1,22 +1,18 @@
-from shortcuts import SENT_MESSAGES_IN_2015
-from wxparser import Parser, Message
+import colorsys
+import sys
+from random import Random
+
+from PIL import ImageColor
 from wordcloud import WordCloud, STOPWORDS
 
+import westats
+from shortcuts import SENT_MESSAGES_IN_2015
+from wxparser import Parser, Message
 
-wxp = Parser('decrypted.db')
-# reddit_thread = wxp.get_group_chat_with_name('/r/beijing', True)
-# gc = reddit_thread.group_chat
-# ppm = gc.calculate_posts_per_member()
-# ranking = list(reversed(sorted(gc.members.keys(), key=lambda member: ppm[member])))
 
 contrasty_colors = ['#e41a1c', '#377eb8', '#4daf4a', '#984ea3', '#ff7f00', '#ffff33', '#a65628', '#f781bf', '#999999']
 
 
-from random import Random
-from PIL import ImageColor
-import colorsys
-
-
 def get_single_color_func(color):
     """Create a color function which returns a single hue and saturation with.
     different values (HSV). Accepted values are color strings as usable by PIL/Pillow.
@@ -50,7 +46,8 @@ def get_single_color_func(color):
     return single_color_func
 
 
-if __name__ == '__main__':
+def main(args):
+    wxp = Parser(args.db_file_path, args.merge, args.sample_rate, only_types=[Message.TYPE_NORMAL])
     all_sent_text_messages_2015 = []
     for thread in wxp.threads:
         for message in SENT_MESSAGES_IN_2015(thread):
@@ -69,5 +66,8 @@ if __name__ == '__main__':
                    width=800,
                    height=800,
                    relative_scaling=1).generate(raw_content)
-    filename = 'cloud.png'
-    wc.to_file(filename)
+    wc.to_file(args.output)
+
+
+if __name__ == '__main__':
+    westats.main(['cloud'] + sys.argv[1:])
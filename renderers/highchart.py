@@ -13,5 +13,8 @@ class HighchartRenderer(object):
         }
         self.highchart_data.update(highchart_data)
 
+    def serialize(self):
+        return self.highchart_data
+
     def render(self):
         return template_env.get_template('highchart.haml').render({'chart_json': json.dumps(self.highchart_data)})
@@ -9,10 +9,13 @@ class TableRenderer(object):
         self.header_row = header_row
         self.rows = rows
 
-    def render(self):
-        return template_env.get_template('table.haml').render({
+    def serialize(self):
+        return {
             'title': self.title,
             'subtitle': self.subtitle,
             'header_row': self.header_row,
             'rows': self.rows
-        })
+        }
+
+    def render(self):
+        return template_env.get_template('table.haml').render(self.serialize())
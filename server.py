@@ -0,0 +1,170 @@
+import BaseHTTPServer
+import hashlib
+import json
+import mimetypes
+import os
+import sys
+import urlparse
+
+import westats
+from renderers import TableRenderer
+from test_2015 import build_cube, report_builders
+from wxparser import Parser, UserData
+
+
+STATIC_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+
+
+class CachedChart(object):
+
+    def __init__(self, renderer):
+        self.json = json.dumps(renderer.serialize())
+        self.html = renderer.render().encode('utf-8')
+        self.json_etag = '"%s"' % hashlib.sha1(self.json).hexdigest()
+        self.html_etag = '"%s"' % hashlib.sha1(self.html).hexdigest()
+
+
+class ReportCache(object):
+
+    def __init__(self, builders):
+        self.builders = {}
+        self.slugs = []
+        for slug, builder, uses_categories in builders:
+            self.builders[slug] = (builder, uses_categories)
+            self.slugs.append(slug)
+        self.charts = {}
+
+    def get(self, slug):
+        if slug not in self.charts:
+            builder, _ = self.builders[slug]
+            self.charts[slug] = CachedChart(builder())
+        return self.charts[slug]
+
+    def invalidate_categorized(self):
+        invalidated = [slug for slug in self.slugs if self.builders[slug][1]]
+        for slug in invalidated:
+            self.charts.pop(slug, None)
+        return invalidated
+
+
+class ReportRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # Set by serve() before the server starts
+    wxp = None
+    userdata = None
+    cube = None
+    cache = None
+    # Host headers (host:port) that name this server
+    own_hosts = ()
+
+    def do_GET(self):
+        path = urlparse.urlparse(self.path).path
+        if path == '/':
+            self._send(200, 'text/html; charset=utf-8', self._render_index())
+        elif path.startswith('/static/'):
+            self._send_static(path[len('/static/'):])
+        elif path.endswith('.json') and path[1:-len('.json')] in self.cache.builders:
+            chart = self.cache.get(path[1:-len('.json')])
+            self._send_cached(chart.json, chart.json_etag, 'application/json')
+        elif path.endswith('.html') and path[1:-len('.html')] in self.cache.builders:
+            chart = self.cache.get(path[1:-len('.html')])
+            self._send_cached(chart.html, chart.html_etag, 'text/html; charset=utf-8')
+        else:
+            self._send(404, 'text/plain', 'Not found')
+
+    def do_POST(self):
+        if urlparse.urlparse(self.path).path != '/categorize':
+            self._send(404, 'text/plain', 'Not found')
+            return
+        if not self._is_same_origin():
+            self._send(403, 'text/plain', 'Cross-origin requests are not allowed')
+            return
+
+        form = urlparse.parse_qs(self.rfile.read(int(self.headers.getheader('Content-Length', 0))))
+        try:
+            thread = self.wxp.get_thread_with_raw_username(form['thread'][0])
+            category_name = form['category'][0].decode('utf-8').strip()
+        except (KeyError, IndexError, UnicodeDecodeError):
+            self._send(400, 'text/plain', 'Expected `thread` and `category` form fields')
+            return
+        except Exception as e:
+            self._send(400, 'text/plain', str(e))
+            return
+
+        category = self.userdata.assign_thread(thread, category_name)
+        self.userdata.save()
+        self.cube.recategorize(thread)
+        self._send(200, 'application/json', json.dumps({
+            'thread': thread.contact.raw_username,
+            'category': category.slug,
+            'invalidated': self.cache.invalidate_categorized(),
+        }))
+
+    def _is_same_origin(self):
+        # Any page open in the browser can post a form here, so only take
+        # requests addressed to this server (which also defeats DNS
+        # rebinding) and, when the browser says where they came from,
+        # only from its own pages. curl sends no Origin and is let through.
+        host = self.headers.getheader('Host', '')
+        if host not in self.own_hosts:
+            return False
+        origin = self.headers.getheader('Origin')
+        return origin is None or origin == 'http://' + host
+
+    def _render_index(self):
+        rows = [(slug, '<a href="/%s.html">html</a>' % slug, '<a href="/%s.json">json</a>' % slug) for slug in self.cache.slugs]
+        return TableRenderer('westats', ['', 'Chart', 'Data'], rows, subtitle=self.wxp.filename).render().encode('utf-8')
+
+    def _send_static(self, relative_path):
+        static_path = os.path.normpath(os.path.join(STATIC_ROOT, relative_path))
+        if not static_path.startswith(STATIC_ROOT + os.sep) or not os.path.isfile(static_path):
+            self._send(404, 'text/plain', 'Not found')
+            return
+        static_file = open(static_path, 'rb')
+        body = static_file.read()
+        static_file.close()
+        self._send(200, mimetypes.guess_type(static_path)[0] or 'application/octet-stream', body)
+
+    def _send_cached(self, body, etag, content_type):
+        if self.headers.getheader('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self._send(200, content_type, body, {'ETag': etag, 'Cache-Control': 'no-cache'})
+
+    def _send(self, status, content_type, body, extra_headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for header, value in (extra_headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(wxp, userdata, host='127.0.0.1', port=8000):
+    ReportRequestHandler.wxp = wxp
+    ReportRequestHandler.userdata = userdata
+    ReportRequestHandler.cube = build_cube(wxp)
+    ReportRequestHandler.cache = ReportCache(report_builders(wxp, userdata, ReportRequestHandler.cube))
+    own_hostnames = [host]
+    if host in ('127.0.0.1', 'localhost', '0.0.0.0', ''):
+        own_hostnames.extend(['127.0.0.1', 'localhost'])
+    ReportRequestHandler.own_hosts = ['%s:%d' % (hostname, port) for hostname in own_hostnames]
+    httpd = BaseHTTPServer.HTTPServer((host, port), ReportRequestHandler)
+    print 'Serving on http://%s:%d/ (CTRL-C to stop)' % (host, port)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    httpd.server_close()
+
+
+def main(args):
+    wxp = Parser(args.db_file_path, args.merge, args.sample_rate)
+    serve(wxp, UserData.initialize(wxp), args.host, args.port)
+
+
+if __name__ == '__main__':
+    westats.main(['serve'] + sys.argv[1:])
@@ -4,11 +4,15 @@ import json
 import sys
 from collections import defaultdict
 from dateutil.relativedelta import relativedelta
+import numpy
 
 import shortcuts
 import utils
+import westats
+from analytics import GROUP_CHATS, AggregateCube, margin_of_error, message_arrays, roll_up_reply_latencies, roll_up_sessions, segment_sessions, streamed_cube, thread_reply_latencies
 from renderers import HighchartRenderer, TableRenderer, VitalsRenderer
-from wxparser import Parser, UserData, Message
+from wxparser import Parser, UserData, Message, GroupChat
+from wxparser.search import SearchIndex
 
 
 contrasty_colors = ['#e41a1c', '#377eb8', '#4daf4a', '#984ea3', '#ff7f00', '#ffff33', '#a65628', '#f781bf', '#999999']
@@ -29,31 +33,24 @@ class NullCategory(object):
     slug = 'other'
 
 
-def build_sent_by_category_by_month_graph(wxp, userdata):
+def build_sent_by_category_by_month_graph(cube, userdata):
     # Build the timespans
     timespans = []
-    rolling_date = datetime.datetime(2015, 1, 1, 0, 0, 0, 0, shortcuts.BEIJING_TIME)
-    while rolling_date < shortcuts.BEGINNING_OF_2016:
+    rolling_date = cube.start
+    while rolling_date < cube.end:
         next_start = rolling_date + relativedelta(months=1)
         timespans.append((rolling_date, next_start))
         rolling_date = next_start
 
     raw_data = defaultdict(lambda: [0] * len(timespans))
-    for thread in wxp.individual_threads:
-        category_slug = thread.category.slug if getattr(thread, 'category', None) else 'other'
-        for i in xrange(0, len(timespans)):
-            from_timestamp, to_timestamp = timespans[i]
-            raw_data[category_slug][i] += len(filter(lambda message: message.sent and message.timestamp >= from_timestamp and message.timestamp < to_timestamp, thread.messages))
-
-    for thread in wxp.group_threads:
-        for i in xrange(0, len(timespans)):
-            from_timestamp, to_timestamp = timespans[i]
-            raw_data['group-chats'][i] += len(filter(lambda message: message.sent and message.timestamp >= from_timestamp and message.timestamp < to_timestamp, thread.messages))
+    sent_by_month = cube.counts(('category', 'month'), sent=True)
+    for code, category_slug in enumerate(cube.category_slugs):
+        raw_data[category_slug] = [int(count) for count in sent_by_month[code]]
 
     sorted_keys = list(reversed(sorted(raw_data.keys(), key=lambda slug: sum(raw_data[slug]))))
 
     series_data = []
-    for series in filter(lambda key: key not in ['other', 'group-chats'], sorted_keys):
+    for series in filter(lambda key: key not in ['other', GROUP_CHATS], sorted_keys):
         series_data.append({
             'name': userdata.categories[series].display_name,
             'data': raw_data[series],
@@ -61,7 +58,7 @@ def build_sent_by_category_by_month_graph(wxp, userdata):
 
     series_data.append({
         'name': 'Group Chats',
-        'data': raw_data['group-chats'],
+        'data': raw_data[GROUP_CHATS],
     })
 
     series_data.append({
@@ -69,7 +66,7 @@ def build_sent_by_category_by_month_graph(wxp, userdata):
         'data': raw_data['other'],
     })
 
-    return HighchartRenderer({
+    return _annotate_sampled_chart(cube, max([max(data) for data in raw_data.values()] or [0]), HighchartRenderer({
         'chart': {
             'type': 'column'
         },
@@ -103,19 +100,21 @@ def build_sent_by_category_by_month_graph(wxp, userdata):
             }
         },
         'series': series_data,
-    })
+    }))
 
 
 class ScatterPlotSeries(object):
 
-    def __init__(self, name, thread_filter, message_filter, color):
+    def __init__(self, name, thread_filter, message_filter, color, points=None):
         self.name = name
         self.thread_filter = thread_filter
         self.message_filter = message_filter
         self.color = color
+        # Precomputed [day, hour] points, used instead of the filters
+        self.points = points
 
 
-def build_message_scatterplot(wxp, title, series_list):
+def build_message_scatterplot(wxp, title, series_list, subtitle=None):
 
     def _day_of_year(timestamp):
         return int((timestamp - shortcuts.BEGINNING_OF_2015).total_seconds() / (60 * 60 * 24))
@@ -131,11 +130,14 @@ def build_message_scatterplot(wxp, title, series_list):
             'color': series.color,
             'data': [],
         })
+        if series.points is not None:
+            series_output[-1]['data'] = series.points
+            continue
         for thread in filter(series.thread_filter, wxp.threads):
             for message in filter(series.message_filter, filter(lambda message: message.timestamp >= shortcuts.BEGINNING_OF_2015 and message.timestamp < shortcuts.BEGINNING_OF_2016, thread.messages)):
                 series_output[-1]['data'].append([_day_of_year(message.timestamp.astimezone(shortcuts.BEIJING_TIME)), _hour_of_day(message.timestamp.astimezone(shortcuts.BEIJING_TIME))])
 
-    return HighchartRenderer({
+    highchart_data = {
         'chart': {
             'type': 'scatter',
             'zoomType': 'xy',
@@ -169,19 +171,31 @@ def build_message_scatterplot(wxp, title, series_list):
             },
         },
         'series': series_output,
-    })
+    }
+    if subtitle:
+        highchart_data['subtitle'] = {
+            'text': subtitle,
+        }
+    return HighchartRenderer(highchart_data)
 
 
-def build_sent_message_by_category_scatterplot(wxp, userdata):
+def build_sent_message_by_category_scatterplot(wxp, cube, userdata):
 
     def _individual_thread_filter_generator(slug):
         return lambda thread: not thread.is_group_chat and getattr(thread, 'category', NullCategory()).slug == slug
 
-    category_sums = defaultdict(lambda: 0)
-    for thread in wxp.individual_threads:
-        if getattr(thread, 'category', NullCategory()).slug == 'other':
-            continue
-        category_sums[thread.category.slug] += len(shortcuts.SENT_MESSAGES_IN_2015(thread))
+    category_sums = {}
+    sent_by_category = cube.counts(('category',), sent=True)
+    for code, category_slug in enumerate(cube.category_slugs):
+        if category_slug not in ['other', GROUP_CHATS]:
+            category_sums[category_slug] = int(sent_by_category[code])
+
+    def _points(slug):
+        # Only a streamed cube has these, already reduced to distinct minutes
+        if cube.sent_minutes is None:
+            return None
+        minutes = cube.sent_minutes[slug].tolist() if slug in cube.sent_minutes else []
+        return [[minute // (60 * 24), round(minute % (60 * 24) // 60 + (minute % 60 / 60.0), 2)] for minute in minutes]
 
     i = 0
     series_list = []
@@ -189,22 +203,26 @@ def build_sent_message_by_category_scatterplot(wxp, userdata):
         series_list.append(ScatterPlotSeries(userdata.categories[category].display_name,
                                              _individual_thread_filter_generator(category),
                                              lambda message: message.sent,
-                                             contrasty_colors_rgba[i]))
+                                             contrasty_colors_rgba[i],
+                                             _points(category)))
         i += 1
 
     series_list.append(ScatterPlotSeries('Group Chats',
                                          lambda thread: thread.is_group_chat,
                                          lambda message: message.sent,
-                                         contrasty_colors_rgba[i]))
+                                         contrasty_colors_rgba[i],
+                                         _points(GROUP_CHATS)))
     i += 1
 
     series_list.append(ScatterPlotSeries('Other',
                                          _individual_thread_filter_generator('other'),
                                          lambda message: message.sent,
-                                         contrasty_colors_rgba[i]))
+                                         contrasty_colors_rgba[i],
+                                         _points('other')))
     i += 1
 
-    return build_message_scatterplot(wxp, 'All Sent Messages (2015)', series_list)
+    subtitle = 'showing a %g%% sample of messages' % (100 * cube.sample_rate) if cube.sample_rate is not None else None
+    return build_message_scatterplot(wxp, 'All Sent Messages (2015)', series_list, subtitle)
 
 
 def _group_chat_alias(original_display_name):
@@ -214,33 +232,37 @@ def _group_chat_alias(original_display_name):
             return original_display_name
 
 
-def build_group_chat_ranking_table(wxp):
+def build_group_chat_ranking_table(wxp, cube):
     group_chat_ranking = []
-    for thread in list(reversed(sorted(wxp.group_threads, key=lambda thread: len(shortcuts.SENT_MESSAGES_IN_2015(thread))))):
+    for thread, my_sent in cube.ranking(sent=True, group_chats=True).descending():
+        if thread not in cube.thread_rows:
+            continue
         display_name = _group_chat_alias(thread.contact.display_name)
         if not display_name:
             continue
-        my_sent = len(shortcuts.SENT_MESSAGES_IN_2015(thread))
-        total_sent = len(shortcuts.MESSAGES_IN_2015(thread))
+        total_sent = cube.thread_counts([thread])[0]
         percent = round(100.0 * my_sent / total_sent, 1)
-        group_chat_ranking.append((display_name, _int_with_comma(my_sent), _int_with_comma(total_sent), percent))
+        group_chat_ranking.append((display_name, _int_with_margin(cube, my_sent), _int_with_margin(cube, total_sent), percent))
         if len(group_chat_ranking) == 8:
             break
 
     return TableRenderer('Top Group Chats (2015)',
                          ['', 'Your<br/>messages', 'Total<br/>messages', '%'],
                          group_chat_ranking,
-                         subtitle='By your messages sent')
+                         subtitle=_sampled_subtitle(cube, 'By your messages sent'))
 
 
-def build_silent_group_chat_ranking_table(wxp):
+def build_silent_group_chat_ranking_table(wxp, cube):
+    sent_counts = cube.ranking(sent=True, group_chats=True).counts
+
     group_chat_ranking = []
-    for thread in reversed(sorted(filter(lambda thread: len(shortcuts.SENT_MESSAGES_IN_2015(thread)) == 0, wxp.group_threads), key=lambda thread: len(shortcuts.MESSAGES_IN_2015(thread)))):
+    for thread, total_sent in cube.ranking(group_chats=True).descending():
+        if thread not in cube.thread_rows or sent_counts[thread] != 0:
+            continue
         display_name = _group_chat_alias(thread.contact.display_name)
         if not display_name:
             continue
-        my_sent = len(shortcuts.SENT_MESSAGES_IN_2015(thread))
-        total_sent = len(shortcuts.MESSAGES_IN_2015(thread))
+        my_sent = sent_counts[thread]
         percent = round(100.0 * my_sent / total_sent, 1)
         group_chat_ranking.append((display_name, _int_with_comma(my_sent), _int_with_comma(total_sent), percent))
         if len(group_chat_ranking) == 8:
@@ -252,46 +274,63 @@ def build_silent_group_chat_ranking_table(wxp):
                          subtitle='Busiest Groups Where You Said Nothing All Year')
 
 
-def build_individual_chat_ranking_table(wxp):
+def build_group_chat_members_table(wxp, cube, uncached=False):
+    busiest_thread = next((thread for thread, count in cube.ranking(group_chats=True).descending()
+                           if count and _group_chat_alias(thread.contact.display_name)), None)
+    if busiest_thread is None:
+        return TableRenderer('Group Chat Regulars (2015)', [], [])
+    if uncached:
+        # Just the senders and times of this period, not kept on the thread
+        create_times, _, sender_ids = busiest_thread.read_message_arrays(shortcuts.BEGINNING_OF_2015, shortcuts.BEGINNING_OF_2016)
+        group_chat = GroupChat(busiest_thread, create_times, sender_ids)
+    else:
+        group_chat = busiest_thread.group_chat
+    posts_per_member = group_chat.calculate_posts_per_member(shortcuts.BEGINNING_OF_2015, shortcuts.BEGINNING_OF_2016)
+    total_posts = group_chat.count_posts(shortcuts.BEGINNING_OF_2015, shortcuts.BEGINNING_OF_2016)
+
+    ranking = []
+    for contact, posts in group_chat.top_posters(10, shortcuts.BEGINNING_OF_2015, shortcuts.BEGINNING_OF_2016):
+        ranking.append((contact.display_name, _int_with_comma(posts), round(100.0 * posts / total_posts, 1) if total_posts else 0.0))
+
+    return TableRenderer('Group Chat Regulars (2015)',
+                         ['', 'Messages', '% of<br/>group'],
+                         ranking,
+                         subtitle='%s: top posters, %d of %d members never said a word' % (_group_chat_alias(busiest_thread.contact.display_name),
+                                                                                          len(filter(lambda posts: posts == 0, posts_per_member.values())),
+                                                                                          len(posts_per_member)))
+
+
+def build_individual_chat_ranking_table(wxp, cube):
+    sent_ranking = cube.ranking(sent=True, group_chats=False)
+    top_threads = sent_ranking.top(10)
+    total_counts = dict(zip([thread for thread, _ in top_threads], cube.thread_counts([thread for thread, _ in top_threads])))
+
     ranking = []
-    total_sent_messages = sum([len(shortcuts.SENT_MESSAGES_IN_2015(thread)) for thread in wxp.threads])
-    for thread in list(reversed(sorted(wxp.individual_threads, key=lambda thread: len(shortcuts.SENT_MESSAGES_IN_2015(thread)))))[:10]:
+    total_sent_messages = int(cube.counts(sent=True))
+    for thread, my_sent in top_threads:
         display_name = thread.contact.display_name
-        my_sent = len(shortcuts.SENT_MESSAGES_IN_2015(thread))
-        total = len(shortcuts.MESSAGES_IN_2015(thread))
-        percent = round(100.0 * len(shortcuts.SENT_MESSAGES_IN_2015(thread)) / total_sent_messages, 1)
-        ranking.append((display_name, _int_with_comma(my_sent), percent, _int_with_comma(total)))
-        if len(ranking) == 10:
-            break
+        total = total_counts[thread]
+        percent = round(100.0 * my_sent / total_sent_messages, 1)
+        ranking.append((display_name, _int_with_margin(cube, my_sent), percent, _int_with_margin(cube, total)))
 
-    top_five_percent = sum(x[2] for x in ranking[:5])
+    top_five_percent = 100.0 * sent_ranking.prefix_sum(5) / total_sent_messages if total_sent_messages else 0.0
 
     return TableRenderer('Top Contacts (2015)',
                          ['', 'Your<br/>messages', '% of all 2015<br/>sent messages', 'Total<br/>messages'],
                          ranking,
-                         subtitle='%.1f%% of your sent messages were to just five people' % top_five_percent)
+                         subtitle=_sampled_subtitle(cube, '%.1f%% of your sent messages were to just five people' % top_five_percent))
 
 
-def build_sent_by_time_heatmap(wxp):
-    time_dict = defaultdict(lambda: [0, 0, 0, 0, 0, 0])
-    for thread in wxp.threads:
-        for message in shortcuts.SENT_MESSAGES_IN_2015(thread):
-            weekday = message.timestamp.astimezone(shortcuts.BEIJING_TIME).weekday()
-            hour_bucket = (message.timestamp.astimezone(shortcuts.BEIJING_TIME).hour / 4)
-            time_dict[weekday][hour_bucket] += 1
-
-    weekdays_in_year_divisor = defaultdict(lambda: 0)
-    rolling_date = shortcuts.BEGINNING_OF_2015
-    while rolling_date < shortcuts.BEGINNING_OF_2016:
-        weekdays_in_year_divisor[rolling_date.weekday()] += 1
-        rolling_date += datetime.timedelta(days=1)
+def build_sent_by_time_heatmap(cube):
+    time_dict = cube.counts(('weekday', 'hour_bucket'), sent=True)
+    weekdays_in_year_divisor = _weekdays_in_period(cube)
 
     series_splayed = []
     for weekday in xrange(0, 7):
         for hour_bucket in xrange(0, 6):
-            series_splayed.append([weekday, hour_bucket, time_dict[weekday][hour_bucket] / weekdays_in_year_divisor[weekday]])
+            series_splayed.append([weekday, hour_bucket, int(time_dict[weekday][hour_bucket]) / weekdays_in_year_divisor[weekday]])
 
-    return HighchartRenderer({
+    return _annotate_sampled_chart(cube, int(time_dict.max()), HighchartRenderer({
         'chart': {
             'type': 'heatmap',
             'marginTop': 40,
@@ -330,33 +369,20 @@ def build_sent_by_time_heatmap(wxp):
                 'color': '#ffffff'
             },
         }],
-    })
+    }))
 
 
-def build_sent_by_category_heatmap(wxp, userdata):
-    category_dict = defaultdict(lambda: defaultdict(lambda: 0))
-    seen_categories = set([])
-    for thread in wxp.individual_threads:
-        category_slug = getattr(thread, 'category', NullCategory()).slug
-        if category_slug == 'other':
-            continue
-        seen_categories.add(category_slug)
-        for message in shortcuts.SENT_MESSAGES_IN_2015(thread):
-            weekday = message.timestamp.astimezone(shortcuts.BEIJING_TIME).weekday()
-            category_dict[weekday][category_slug] += 1
-
-    weekdays_in_year_divisor = defaultdict(lambda: 0)
-    rolling_date = shortcuts.BEGINNING_OF_2015
-    while rolling_date < shortcuts.BEGINNING_OF_2016:
-        weekdays_in_year_divisor[rolling_date.weekday()] += 1
-        rolling_date += datetime.timedelta(days=1)
+def build_sent_by_category_heatmap(cube, userdata):
+    sent_by_weekday = cube.counts(('category', 'weekday'), sent=True)
+    seen_categories = set(filter(lambda slug: slug not in ['other', GROUP_CHATS], cube.category_slugs))
+    weekdays_in_year_divisor = _weekdays_in_period(cube)
 
     series_splayed = []
     for weekday in xrange(0, 7):
         for i, category_slug in enumerate(sorted(seen_categories)):
-            series_splayed.append([weekday, i, category_dict[weekday][category_slug] / weekdays_in_year_divisor[weekday]])
+            series_splayed.append([weekday, i, int(sent_by_weekday[cube.category_slugs.index(category_slug)][weekday]) / weekdays_in_year_divisor[weekday]])
 
-    return HighchartRenderer({
+    return _annotate_sampled_chart(cube, int(sent_by_weekday.max()) if sent_by_weekday.size else 0, HighchartRenderer({
         'chart': {
             'type': 'heatmap',
             'marginTop': 40,
@@ -395,64 +421,376 @@ def build_sent_by_category_heatmap(wxp, userdata):
                 'color': '#ffffff'
             },
         }],
-    })
+    }))
+
 
+def build_scalars_table(wxp, cube):
+    individual_threads = filter(lambda thread: thread in cube.thread_rows, wxp.individual_threads)
+    group_threads = filter(lambda thread: thread in cube.thread_rows, wxp.group_threads)
 
-def build_scalars_table(wxp):
-    individual_sent_messages = sum([len(shortcuts.SENT_MESSAGES_IN_2015(thread)) for thread in wxp.individual_threads])
-    group_sent_messages = sum([len(shortcuts.SENT_MESSAGES_IN_2015(thread)) for thread in wxp.group_threads])
+    individual_sent_messages = int(cube.counts(sent=True, threads=individual_threads))
+    group_sent_messages = int(cube.counts(sent=True, threads=group_threads))
     total_sent_messages = individual_sent_messages + group_sent_messages
 
-    individual_received_messages = sum([len(filter(lambda message: not message.sent, shortcuts.MESSAGES_IN_2015(thread))) for thread in wxp.individual_threads])
-    group_received_messages = sum([len(filter(lambda message: not message.sent, shortcuts.MESSAGES_IN_2015(thread))) for thread in wxp.group_threads])
+    individual_received_messages = int(cube.counts(sent=False, threads=individual_threads))
+    group_received_messages = int(cube.counts(sent=False, threads=group_threads))
 
     blank_row = ['' * 3]
 
-    individual_chat_count = len(filter(lambda thread: len(shortcuts.MESSAGES_IN_2015(thread)) > 0, wxp.individual_threads))
-    group_chat_count = len(filter(lambda thread: len(shortcuts.MESSAGES_IN_2015(thread)) > 0, wxp.group_threads))
+    individual_chat_count = len(individual_threads)
+    group_chat_count = len(group_threads)
 
-    sent_sticker_count = sum([len(filter(lambda message: message.type == Message.TYPE_STICKER, shortcuts.SENT_MESSAGES_IN_2015(thread))) for thread in wxp.threads])
-    received_sticker_count = sum([len(filter(lambda message: not message.sent and message.type == Message.TYPE_STICKER, shortcuts.MESSAGES_IN_2015(thread))) for thread in wxp.threads])
+    sent_sticker_count = int(cube.counts(sent=True, types=[Message.TYPE_STICKER]))
+    received_sticker_count = int(cube.counts(sent=False, types=[Message.TYPE_STICKER]))
 
-    sent_hongbao_count = sum([len(filter(lambda message: message.type in [Message.TYPE_HONGBAO, Message.TYPE_TRANSFER], shortcuts.SENT_MESSAGES_IN_2015(thread))) for thread in wxp.threads])
-    received_hongbao_count = sum([len(filter(lambda message: not message.sent and message.type in [Message.TYPE_HONGBAO, Message.TYPE_TRANSFER], shortcuts.MESSAGES_IN_2015(thread))) for thread in wxp.individual_threads])
+    sent_hongbao_count = int(cube.counts(sent=True, types=[Message.TYPE_HONGBAO, Message.TYPE_TRANSFER]))
+    received_hongbao_count = int(cube.counts(sent=False, types=[Message.TYPE_HONGBAO, Message.TYPE_TRANSFER], threads=individual_threads))
 
     rows = [
-        ['In 2015, you sent', _int_with_comma(total_sent_messages), 'messages'],
-        ['', _int_with_comma(individual_sent_messages), 'were to individuals,'],
-        ['and', _int_with_comma(group_sent_messages), 'were to groups'],
+        ['In 2015, you sent', _int_with_margin(cube, total_sent_messages), 'messages'],
+        ['', _int_with_margin(cube, individual_sent_messages), 'were to individuals,'],
+        ['and', _int_with_margin(cube, group_sent_messages), 'were to groups'],
         blank_row,
         blank_row,
-        ['You received', _int_with_comma(individual_received_messages + group_received_messages), 'messages'],
-        ['', _int_with_comma(individual_received_messages), 'from individuals'],
-        ['and', _int_with_comma(group_received_messages), 'via groups'],
+        ['You received', _int_with_margin(cube, individual_received_messages + group_received_messages), 'messages'],
+        ['', _int_with_margin(cube, individual_received_messages), 'from individuals'],
+        ['and', _int_with_margin(cube, group_received_messages), 'via groups'],
         blank_row,
         blank_row,
-        ['You talked to', individual_chat_count, 'people via individual chat'],
-        ['and were in', group_chat_count, 'active group chats'],
+        ['You talked to', _at_least(cube, individual_chat_count), 'people via individual chat'],
+        ['and were in', _at_least(cube, group_chat_count), 'active group chats'],
         blank_row,
         blank_row,
-        ['You sent', _int_with_comma(sent_sticker_count), 'stickers'],
-        ['and received', _int_with_comma(received_sticker_count), ''],
+        ['You sent', _int_with_margin(cube, sent_sticker_count), 'stickers'],
+        ['and received', _int_with_margin(cube, received_sticker_count), ''],
         blank_row,
         blank_row,
-        ['You sent', _int_with_comma(sent_hongbao_count), u'\u7ea2\u5305 / \u8f6c\u8d26'],
-        ['and received', _int_with_comma(received_hongbao_count), '(excluding groups)'],
+        ['You sent', _int_with_margin(cube, sent_hongbao_count), u'\u7ea2\u5305 / \u8f6c\u8d26'],
+        ['and received', _int_with_margin(cube, received_hongbao_count), '(excluding groups)'],
     ]
 
     return VitalsRenderer('Vitals (2015)',
                           blank_row,
-                          rows)
+                          rows,
+                          subtitle=_sampled_subtitle(cube, ''))
+
+
+REPLY_WINDOW = datetime.timedelta(hours=24)
+SESSION_GAP = datetime.timedelta(hours=1)
+
+
+class IndividualThreadActivity(object):
+    """Reply latencies and conversations of every individual thread, worked
+    out together from one read of each thread, on first use, and shared by
+    every chart that needs them. Roll-ups by category follow the threads'
+    current categories.
+    """
+
+    def __init__(self, wxp, arrays_selector):
+        self.wxp = wxp
+        self.arrays_selector = arrays_selector
+        self._latencies_by_thread = None
+        self._thread_sessions = None
+
+    def _read(self):
+        if self._latencies_by_thread is not None:
+            return
+        self._latencies_by_thread = {}
+        self._thread_sessions = []
+        for thread in self.wxp.individual_threads:
+            create_times, sent = self.arrays_selector(thread)
+            self._latencies_by_thread[thread] = thread_reply_latencies(create_times, sent, REPLY_WINDOW)
+            self._thread_sessions.append((thread, segment_sessions(create_times, sent, SESSION_GAP)))
+
+    @property
+    def latencies_by_thread(self):
+        self._read()
+        return self._latencies_by_thread
+
+    def latencies_by_category(self):
+        return roll_up_reply_latencies(self.latencies_by_thread)
+
+    def sessions_by_category(self):
+        self._read()
+        return roll_up_sessions(self._thread_sessions)
+
+
+def build_reply_latency_by_category_graph(activity, userdata):
+    by_category = activity.latencies_by_category()
+
+    sorted_slugs = _sorted_category_slugs(by_category, lambda latencies: latencies.mine.count)
+
+    def _median_minutes(histogram):
+        return round(histogram.median / 60, 1) if histogram.count else None
+
+    return HighchartRenderer({
+        'chart': {
+            'type': 'column'
+        },
+        'title': {
+            'text': 'Median Reply Time (2015)'
+        },
+        'subtitle': {
+            'text': 'by category, individual chats, replies within 24 hours'
+        },
+        'colors': [contrasty_colors[2], contrasty_colors[1]],
+        'xAxis': {
+            'categories': [_category_display_name(userdata, slug) for slug in sorted_slugs],
+        },
+        'yAxis': {
+            'title': {
+                'text': 'Minutes'
+            },
+        },
+        'tooltip': {
+            'shared': True,
+            'valueSuffix': ' minutes'
+        },
+        'series': [{
+            'name': 'You',
+            'data': [_median_minutes(by_category[slug].mine) for slug in sorted_slugs],
+        }, {
+            'name': 'Them',
+            'data': [_median_minutes(by_category[slug].theirs) for slug in sorted_slugs],
+        }],
+    })
+
+
+def build_reply_latency_ranking_table(wxp, activity, minimum_replies=20):
+    by_thread = activity.latencies_by_thread
+
+    ranking = []
+    # Ties keep contact order rather than dict order
+    for thread in sorted(filter(lambda thread: thread in by_thread and by_thread[thread].mine.count >= minimum_replies, wxp.individual_threads), key=lambda thread: by_thread[thread].mine.median)[:10]:
+        latencies = by_thread[thread]
+        ranking.append((thread.contact.display_name,
+                        _duration(latencies.mine.median),
+                        _duration(latencies.theirs.median) if latencies.theirs.count else '-',
+                        _int_with_comma(latencies.mine.count)))
+
+    return TableRenderer('Fastest Replies (2015)',
+                         ['', 'Your median<br/>reply time', 'Their median<br/>reply time', 'Your<br/>replies'],
+                         ranking,
+                         subtitle='Contacts you answered at least %d times' % minimum_replies)
+
+
+def build_conversation_starts_by_category_graph(activity, userdata):
+    by_category = activity.sessions_by_category()
+    sorted_slugs = _sorted_category_slugs(by_category, len)
+
+    return HighchartRenderer({
+        'chart': {
+            'type': 'bar'
+        },
+        'title': {
+            'text': 'Who Starts the Conversation (2015)'
+        },
+        'subtitle': {
+            'text': 'by category, individual chats, after an hour of silence'
+        },
+        'colors': [contrasty_colors[2], contrasty_colors[1]],
+        'xAxis': {
+            'categories': [_category_display_name(userdata, slug) for slug in sorted_slugs],
+        },
+        'yAxis': {
+            'title': {
+                'text': '% of conversations'
+            },
+        },
+        'tooltip': {
+            'shared': True,
+            'valueSuffix': ' conversations'
+        },
+        'plotOptions': {
+            'bar': {
+                'stacking': 'percent',
+            }
+        },
+        'series': [{
+            'name': 'You',
+            'data': [int(by_category[slug]['initiated'].sum()) for slug in sorted_slugs],
+        }, {
+            'name': 'Them',
+            'data': [int((~by_category[slug]['initiated']).sum()) for slug in sorted_slugs],
+        }],
+    })
+
+
+def build_conversation_table(activity, userdata):
+    by_category = activity.sessions_by_category()
+    days = (shortcuts.BEGINNING_OF_2016 - shortcuts.BEGINNING_OF_2015).days
+
+    rows = []
+    for slug in _sorted_category_slugs(by_category, len):
+        sessions = by_category[slug]
+        if len(sessions) == 0:
+            continue
+        rows.append((_category_display_name(userdata, slug),
+                     round(float(len(sessions)) / days, 1),
+                     int(numpy.median(sessions['count'])),
+                     _duration(numpy.median(sessions['end'] - sessions['start']) / 1000.0),
+                     round(100.0 * sessions['initiated'].sum() / len(sessions), 1)))
+
+    return TableRenderer('Conversations (2015)',
+                         ['', 'Per<br/>day', 'Median<br/>messages', 'Median<br/>length', '% started<br/>by you'],
+                         rows,
+                         subtitle='A conversation ends after an hour of silence')
+
+
+def build_keyword_trend_graph(search_index, keywords):
+    months = []
+    rolling_date = shortcuts.BEGINNING_OF_2015
+    while rolling_date < shortcuts.BEGINNING_OF_2016:
+        months.append(rolling_date.strftime('%Y-%m'))
+        rolling_date += relativedelta(months=1)
+
+    series_data = []
+    for keyword in keywords:
+        monthly_counts = search_index.monthly_counts(keyword, shortcuts.BEGINNING_OF_2015, shortcuts.BEGINNING_OF_2016)
+        series_data.append({
+            'name': keyword,
+            'data': [monthly_counts.get(month, 0) for month in months],
+        })
+
+    return HighchartRenderer({
+        'chart': {
+            'type': 'line'
+        },
+        'title': {
+            'text': 'Keyword Mentions (2015)'
+        },
+        'subtitle': {
+            'text': 'text messages, sent and received, by month'
+        },
+        'colors': contrasty_colors,
+        'xAxis': {
+            'categories': months,
+        },
+        'yAxis': {
+            'title': {
+                'text': 'Messages'
+            },
+            'min': 0,
+        },
+        'tooltip': {
+            'shared': True,
+            'valueSuffix': ' messages'
+        },
+        'series': series_data,
+    })
+
+
+def _weekdays_in_period(cube):
+    weekdays_in_period = defaultdict(lambda: 0)
+    rolling_date = cube.start
+    while rolling_date < cube.end:
+        weekdays_in_period[rolling_date.weekday()] += 1
+        rolling_date += datetime.timedelta(days=1)
+    return weekdays_in_period
+
+
+def _sorted_category_slugs(by_category, size):
+    sorted_slugs = list(reversed(sorted(filter(lambda slug: slug != 'other', by_category.keys()), key=lambda slug: size(by_category[slug]))))
+    if 'other' in by_category:
+        sorted_slugs.append('other')
+    return sorted_slugs
+
+
+def _category_display_name(userdata, slug):
+    return userdata.categories[slug].display_name if slug != 'other' else 'Other'
+
+
+def _duration(seconds):
+    if seconds < 60:
+        return '%ds' % seconds
+    if seconds < 60 * 60:
+        return '%.1fm' % (seconds / 60)
+    return '%.1fh' % (seconds / (60 * 60))
 
 
 def _int_with_comma(integer):
     return '{:,d}'.format(integer)
 
 
-if __name__ == '__main__':
-    parser = utils.argparser_with_generic_arguments('Do all the things.')
-    args = parser.parse_args()
-    wxp = Parser(args.db_file_path)
+def _int_with_margin(cube, estimate):
+    if cube.sample_rate is None:
+        return _int_with_comma(estimate)
+    return u'%s \u00b1 %s' % (_int_with_comma(estimate), _int_with_comma(int(round(margin_of_error(estimate, cube.sample_rate)))))
+
+
+def _at_least(cube, observed_count):
+    # A row sample can miss a contact entirely, so what it saw is a floor
+    return u'\u2265 %d' % observed_count if cube.sample_rate is not None else observed_count
+
+
+def _sampled_subtitle(cube, subtitle):
+    if cube.sample_rate is None:
+        return subtitle
+    note = u'estimated from a %g%% sample; \u00b1 is the 95%% confidence interval' % (100 * cube.sample_rate)
+    return u'%s (%s)' % (subtitle, note) if subtitle else note
+
+
+def _annotate_sampled_chart(cube, largest_count, renderer):
+    if cube.sample_rate is None:
+        return renderer
+    note = u'estimated from a %g%% sample; largest value \u00b1%.0f%% at 95%% confidence' % (100 * cube.sample_rate,
+                                                                                              100.0 * margin_of_error(largest_count, cube.sample_rate) / largest_count if largest_count else 0)
+    subtitle = renderer.highchart_data.get('subtitle', {}).get('text')
+    renderer.highchart_data['subtitle'] = {
+        'text': u'%s; %s' % (subtitle, note) if subtitle else note,
+    }
+    return renderer
+
+
+def _message_arrays_in_2015(thread):
+    return message_arrays(shortcuts.MESSAGES_IN_2015(thread))
+
+
+def _uncached_message_arrays_in_2015(thread):
+    create_times, sent, _ = thread.read_message_arrays(shortcuts.BEGINNING_OF_2015, shortcuts.BEGINNING_OF_2016)
+    return create_times, sent
+
+
+def build_cube(wxp, memory_budget=None):
+    if memory_budget:
+        return streamed_cube(wxp, shortcuts.BEGINNING_OF_2015, shortcuts.BEGINNING_OF_2016, memory_budget)
+    return AggregateCube(wxp.threads, shortcuts.BEGINNING_OF_2015, shortcuts.BEGINNING_OF_2016, wxp.sample_rate)
+
+
+def report_builders(wxp, userdata, cube, search_index=None, keywords=(), memory_budget=None):
+    # With a memory budget, per-thread analyses read one thread at a
+    # time and let it go, rather than keeping every thread's messages
+    activity = IndividualThreadActivity(wxp, _uncached_message_arrays_in_2015 if memory_budget else _message_arrays_in_2015)
+
+    # (slug, builder, whether the output depends on thread categories)
+    builders = [
+        ('sent-by-category-by-month', lambda: build_sent_by_category_by_month_graph(cube, userdata), True),
+        ('sent-by-category-scatterplot', lambda: build_sent_message_by_category_scatterplot(wxp, cube, userdata), True),
+        ('individual-chat-ranking', lambda: build_individual_chat_ranking_table(wxp, cube), False),
+        ('group-chat-ranking', lambda: build_group_chat_ranking_table(wxp, cube), False),
+        ('silent-group-chat-ranking', lambda: build_silent_group_chat_ranking_table(wxp, cube), False),
+        ('sent-by-time-heatmap', lambda: build_sent_by_time_heatmap(cube), False),
+        ('sent-by-category-heatmap', lambda: build_sent_by_category_heatmap(cube, userdata), True),
+        ('vitals', lambda: build_scalars_table(wxp, cube), False),
+        ('reply-latency-by-category', lambda: build_reply_latency_by_category_graph(activity, userdata), True),
+        ('reply-latency-ranking', lambda: build_reply_latency_ranking_table(wxp, activity), False),
+        ('conversation-starts-by-category', lambda: build_conversation_starts_by_category_graph(activity, userdata), True),
+        ('conversations', lambda: build_conversation_table(activity, userdata), True),
+        ('group-chat-members', lambda: build_group_chat_members_table(wxp, cube, uncached=bool(memory_budget)), False),
+    ]
+    if wxp.sample_rate is not None:
+        # These need every message (turns, silences, who never posted),
+        # which a sample cannot give, so a preview leaves them out
+        exact_only = ['silent-group-chat-ranking', 'reply-latency-by-category', 'reply-latency-ranking',
+                      'conversation-starts-by-category', 'conversations', 'group-chat-members']
+        builders = filter(lambda builder: builder[0] not in exact_only, builders)
+    if keywords:
+        builders.append(('keyword-trends', lambda: build_keyword_trend_graph(search_index, keywords), False))
+    return builders
+
+
+def main(args):
+    wxp = Parser(args.db_file_path, args.merge, args.sample_rate)
     userdata = UserData.initialize(wxp)
 
     if len(userdata.categories) == 0:
@@ -460,20 +798,18 @@ if __name__ == '__main__':
         print 'You have not yet added any categorizations for threads.'
         print 'This will result in missing or suboptimal output.'
         print
-        print 'You should run `python categorize.py` to categorize, before you run this script.'
+        print 'You should run `python westats.py categorize` to categorize, before you run this script.'
         print
         sys.exit(1)
 
-    renderers = [
-        lambda: build_sent_by_category_by_month_graph(wxp, userdata),
-        lambda: build_sent_message_by_category_scatterplot(wxp, userdata),
-        lambda: build_individual_chat_ranking_table(wxp),
-        lambda: build_group_chat_ranking_table(wxp),
-        lambda: build_silent_group_chat_ranking_table(wxp),
-        lambda: build_sent_by_time_heatmap(wxp),
-        lambda: build_sent_by_category_heatmap(wxp, userdata),
-        lambda: build_scalars_table(wxp),
-    ]
+    search_index = None
+    if args.keywords:
+        print 'Updating search index...'
+        search_index = SearchIndex(wxp)
+        search_index.update()
+
+    memory_budget = args.memory_budget * 1024 * 1024 if args.memory_budget else None
+    renderers = [builder for _, builder, _ in report_builders(wxp, userdata, build_cube(wxp, memory_budget), search_index, args.keywords, memory_budget)]
 
     for i in xrange(0, len(renderers)):
         print 'Building renderer %d...' % i
@@ -482,3 +818,9 @@ if __name__ == '__main__':
         chart_file = codecs.open('chart%d.html' % i, 'w', encoding='utf-8')
         chart_file.write(renderer.render())
         chart_file.close()
+
+    utils.print_skipped_message_types(wxp, shortcuts.BEGINNING_OF_2015, shortcuts.BEGINNING_OF_2016)
+
+
+if __name__ == '__main__':
+    westats.main(['report'] + sys.argv[1:])
@@ -3,15 +3,61 @@ import re
 import unicodedata
 
 
-def argparser_with_generic_arguments(description):
-    parser = argparse.ArgumentParser(description=description)
+class FuzzyRange(object):
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+    def __eq__(self, other):
+        return self.start <= other <= self.end
+
+
+def sample_rate(value):
+    rate = float(value)
+    if not 0.0 < rate <= 1.0:
+        raise argparse.ArgumentTypeError('must be more than 0.0 and at most 1.0, not %s' % value)
+    return rate
+
+
+def add_generic_arguments(parser):
     parser.add_argument('db_file_path',
                         metavar='DECRYPTED_DATABASE_FILE',
                         type=str,
                         help='path to the decrypted SQLite database you want to use')
+    parser.add_argument('--merge',
+                        metavar='DECRYPTED_DATABASE_FILE',
+                        type=str,
+                        action='append',
+                        default=[],
+                        help='another decrypted database (old phone, reinstall, backup) whose history should be merged in; may be repeated')
+    parser.add_argument('--sample',
+                        metavar='RATE',
+                        type=sample_rate,
+                        default=None,
+                        dest='sample_rate',
+                        help='for a quick preview, only read a reproducible sample of this fraction of messages (e.g. 0.1) \
+                              and scale counts up; must be more than 0.0 and at most 1.0')
     return parser
 
 
+def print_skipped_message_types(wxp, start, end):
+    skipped_counts = wxp.skipped_message_counts(start, end)
+    if not skipped_counts:
+        return
+    print
+    if wxp.sample_rate is None:
+        print 'Skipped {:,d} messages of types westats does not recognize:'.format(sum(skipped_counts.values()))
+    else:
+        # Scaled up like every other count of a sampled report
+        skipped_counts = dict((raw_type, int(round(count / wxp.sample_rate))) for raw_type, count in skipped_counts.items())
+        print 'Skipped about {:,d} messages of types westats does not recognize (estimated from a {:g}% sample):'.format(sum(skipped_counts.values()),
+                                                                                                                    100 * wxp.sample_rate)
+    for raw_type, count in sorted(skipped_counts.items(), key=lambda item: (-item[1], item[0])):
+        print '{:>12d}: {:,d}'.format(raw_type, count)
+    print 'To include them, map these types onto known ones in message_types.json.'
+
+
 def slugify(value):
     value = unicodedata.normalize('NFKD', unicode(value)).encode('ascii', 'ignore').decode('ascii')
     value = re.sub('[^\w\s-]', '', value).strip().lower()
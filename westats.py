@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+import argparse
+
+import utils
+
+
+# Each command imports its module only when it runs, so that
+# `--help` never pays for numpy, jinja2, wordcloud and friends
+
+def run_categorize(args):
+    import categorize
+    categorize.main(args)
+
+
+def run_report(args):
+    import test_2015
+    test_2015.main(args)
+
+
+def run_cloud(args):
+    import cloud
+    cloud.main(args)
+
+
+def run_serve(args):
+    import server
+    server.main(args)
+
+
+def build_argument_parser():
+    parser = argparse.ArgumentParser(description='Stats and visualizations for a decrypted WeChat database.')
+    subparsers = parser.add_subparsers(title='commands', metavar='COMMAND')
+
+    categorize_parser = utils.add_generic_arguments(subparsers.add_parser('categorize', help='simple tool to help you categorize threads'))
+    categorize_parser.add_argument('threshold',
+                                   metavar='THRESHOLD',
+                                   type=float,
+                                   nargs='?',
+                                   choices=[utils.FuzzyRange(0.0, 1.0)],
+                                   default=0.85,
+                                   help='threshold for portion of threads to categorize; \
+                                         threads are ordered from most to least popular, by your sent messages; \
+                                         must be between 0.0 and 1.0 (default 0.85)')
+    categorize_parser.add_argument('--bulk-accept',
+                                   metavar='CONFIDENCE',
+                                   type=float,
+                                   choices=[utils.FuzzyRange(0.0, 1.0)],
+                                   default=None,
+                                   help='before asking about threads one by one, offer to accept in bulk every suggested \
+                                         category at least this confident (between 0.0 and 1.0), one confirmation per category')
+    categorize_parser.set_defaults(run=run_categorize)
+
+    report_parser = utils.add_generic_arguments(subparsers.add_parser('report', help='do all the things: write chart0.html, chart1.html, ...'))
+    report_parser.add_argument('--keyword',
+                               metavar='TERM',
+                               type=lambda term: term.decode('utf-8'),
+                               dest='keywords',
+                               action='append',
+                               default=[],
+                               help='also chart monthly mentions of TERM (a word or phrase); may be repeated')
+    report_parser.add_argument('--memory-budget',
+                               metavar='MEGABYTES',
+                               type=int,
+                               default=None,
+                               help='for databases too large to load whole: stream messages instead of keeping them, \
+                                     spilling intermediate counts to temporary files beyond this many megabytes')
+    report_parser.set_defaults(run=run_report)
+
+    cloud_parser = utils.add_generic_arguments(subparsers.add_parser('cloud', help='draw a word cloud of your sent text messages'))
+    cloud_parser.add_argument('--output',
+                              metavar='FILE',
+                              type=str,
+                              default='cloud.png',
+                              help='where to write the image (default cloud.png)')
+    cloud_parser.set_defaults(run=run_cloud)
+
+    serve_parser = utils.add_generic_arguments(subparsers.add_parser('serve', help='serve the report over local HTTP, keeping the parsed database in memory'))
+    serve_parser.add_argument('--host',
+                              type=str,
+                              default='127.0.0.1',
+                              help='interface to listen on (default 127.0.0.1)')
+    serve_parser.add_argument('--port',
+                              type=int,
+                              default=8000,
+                              help='port to listen on (default 8000)')
+    serve_parser.set_defaults(run=run_serve)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_argument_parser().parse_args(argv)
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
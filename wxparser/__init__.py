@@ -1,7 +1,15 @@
+import collections
 import datetime
+import heapq
+import itertools
 import json
+import Queue
 import re
 import sqlite3
+import threading
+from multiprocessing.pool import ThreadPool
+
+import numpy
 
 from utils import slugify
 
@@ -25,6 +33,23 @@ def _aware_time_to_unix_timestamp(aware_time):
     return (aware_time - datetime.datetime(1970, 1, 1, 0, 0, 0, 0, utc)).total_seconds()
 
 
+def _aware_time_to_milliseconds(aware_time):
+    # createTime is stored in milliseconds
+    return int(_aware_time_to_unix_timestamp(aware_time) * 1000)
+
+
+def _period_filters(start, end):
+    clauses = []
+    arguments = []
+    if start is not None:
+        clauses.append('createTime>=?')
+        arguments.append(_aware_time_to_milliseconds(start))
+    if end is not None:
+        clauses.append('createTime<?')
+        arguments.append(_aware_time_to_milliseconds(end))
+    return clauses, arguments
+
+
 def _find_exactly_one(iterable, filter_callable):
     candidates = filter(filter_callable, iterable)
     if len(candidates) == 0:
@@ -74,6 +99,16 @@ class UserData(object):
     def categories_as_list(self):
         return sorted(self.categories.values(), key=lambda category: category.display_name)
 
+    def assign_thread(self, thread, category_name):
+        slug = slugify(category_name)
+        if slug not in self.categories:
+            self.add_category(Category(category_name))
+        previous_category = getattr(thread, 'category', None)
+        if previous_category:
+            previous_category.remove_thread(thread)
+        self.categories[slug].add_thread(thread)
+        return self.categories[slug]
+
 
 class Category(object):
 
@@ -93,6 +128,10 @@ class Category(object):
         self.threads.append(thread)
         thread.category = self
 
+    def remove_thread(self, thread):
+        self.threads.remove(thread)
+        del thread.category
+
     @classmethod
     def deserialize(cls, object_from_json, parser_instance):
         deserialized_object = cls(object_from_json['display_name'])
@@ -124,52 +163,94 @@ class Message(object):
     TYPE_HONGBAO             = 14
     TYPE_UNKNOWN             = 15
 
-    def __init__(self, db_row):
-        self.timestamp = datetime.datetime.fromtimestamp(float(db_row['createTime']) / 1000, utc)
+    # message.type column value -> TYPE_*
+    RAW_TYPES = {
+        1:         TYPE_NORMAL,
+        3:         TYPE_IMAGE,
+        34:        TYPE_ASYNC_VOICE,
+        42:        TYPE_CONTACT_CARD,
+        43:        TYPE_VIDEO,
+        47:        TYPE_STICKER,
+        1048625:   TYPE_STICKER,
+        48:        TYPE_LOCATION_PIN,
+        49:        TYPE_MUSIC_LINK,
+        50:        TYPE_REALTIME_VOICE_CHAT,
+        62:        TYPE_SIGHT,
+        10000:     TYPE_SYSTEM_MESSAGE,
+        10002:     TYPE_SYSTEM_MESSAGE,
+        16777265:  TYPE_EXTERNAL_APP_SHARE,
+        419430449: TYPE_TRANSFER,
+        436207665: TYPE_HONGBAO,
+    }
+
+    def __init__(self, db_row, message_type=None):
+        self.create_time = db_row['createTime']
+        self.timestamp = datetime.datetime.fromtimestamp(float(self.create_time) / 1000, utc)
         self.sent = True if db_row['isSend'] else False
-        self._process_type(db_row['type'])
+        if message_type is None:
+            self._process_type(db_row['type'])
+        else:
+            self.type = message_type
         self.content = db_row['content']
+        self.sender_id = None
 
     def _process_type(self, message_type):
-        if message_type == 1:
-            self.type = Message.TYPE_NORMAL
-        elif message_type == 3:
-            self.type = Message.TYPE_IMAGE
-        elif message_type == 34:
-            self.type = Message.TYPE_ASYNC_VOICE
-        elif message_type == 42:
-            self.type = Message.TYPE_CONTACT_CARD
-        elif message_type == 43:
-            self.type = Message.TYPE_VIDEO
-        elif message_type == 47 or message_type == 1048625:
-            self.type = Message.TYPE_STICKER
-        elif message_type == 48:
-            self.type = Message.TYPE_LOCATION_PIN
-        elif message_type == 49:
-            self.type = Message.TYPE_MUSIC_LINK
-        elif message_type == 50:
-            self.type = Message.TYPE_REALTIME_VOICE_CHAT
-        elif message_type == 62:
-            self.type = Message.TYPE_SIGHT
-        elif message_type == 10000 or message_type == 10002:
-            self.type = Message.TYPE_SYSTEM_MESSAGE
-        elif message_type == 16777265:
-            self.type = Message.TYPE_EXTERNAL_APP_SHARE
-        elif message_type == 419430449:
-            self.type = Message.TYPE_TRANSFER
-        elif message_type == 436207665:
-            self.type = Message.TYPE_HONGBAO
-        else:
+        if message_type not in Message.RAW_TYPES:
             raise UnknownMessageTypeException('Uncategorized message type %d!' % message_type)
+        self.type = Message.RAW_TYPES[message_type]
+
+
+class MessageTypeRegistry(object):
+    """Decodes message.type values into Message.TYPE_*.
+
+    Starts from Message.RAW_TYPES; newer WeChat versions' codes can be
+    mapped onto the same TYPE_* in message_types.json, e.g.
+    {"1090519089": "EXTERNAL_APP_SHARE"}.
+    """
+
+    def __init__(self, raw_types):
+        self.raw_types = raw_types
+
+    @classmethod
+    def initialize(cls):
+        registry = cls(dict(Message.RAW_TYPES))
+        try:
+            config_file = open('message_types.json', 'r')
+        except IOError:
+            return registry
+
+        config = json.loads(config_file.read())
+        config_file.close()
+        for raw_type, type_name in config.items():
+            message_type = getattr(Message, 'TYPE_' + type_name.upper(), None)
+            if message_type is None:
+                known_names = sorted(name[len('TYPE_'):] for name in vars(Message) if name.startswith('TYPE_'))
+                raise UnknownMessageTypeException('message_types.json maps %s onto unknown type "%s"; known types are %s'
+                                                  % (raw_type, type_name, ', '.join(known_names)))
+            registry.register(int(raw_type), message_type)
+        return registry
+
+    def register(self, raw_type, message_type):
+        self.raw_types[raw_type] = message_type
+
+    def decode(self, raw_type):
+        return self.raw_types.get(raw_type)
+
+    def raw_types_for(self, message_types):
+        return sorted(raw_type for raw_type, message_type in self.raw_types.items() if message_type in message_types)
 
 
 class Thread(object):
 
     groupchat_regex = re.compile('\d+@chatroom')
 
-    def __init__(self, cursor, contact):
+    def __init__(self, parser, contact):
         self.contact = contact
-        self.cursor = cursor
+        self.parser = parser
+        self._messages = None
+        self._group_chat = None
+        # Reentrant, since building the group chat loads the messages
+        self._lock = threading.RLock()
 
     @property
     def is_group_chat(self):
@@ -177,17 +258,152 @@ class Thread(object):
 
     @property
     def messages(self):
-        if not getattr(self, '_messages', None):
-            self._parse_messages()
+        if self._messages is None:
+            with self._lock:
+                if self._messages is None:
+                    self._parse_messages()
         return self._messages
 
+    @property
+    def group_chat(self):
+        if not self.is_group_chat:
+            return None
+        if self._group_chat is None:
+            with self._lock:
+                if self._group_chat is None:
+                    self._group_chat = GroupChat(self)
+        return self._group_chat
+
+    def read_messages(self, start=None, end=None):
+        """Parse this thread's messages (only those from `start` up to `end`,
+        when given) without keeping them, for callers that look at one
+        thread at a time and must bound memory.
+        """
+        messages = []
+        is_group_chat = self.is_group_chat
+        message_types = self.parser.message_types
+        for row in self.parser.message_rows(self.contact.raw_username, start, end):
+            message_type = message_types.decode(row['type'])
+            if message_type is None:
+                continue
+            message = Message(row, message_type)
+            if is_group_chat:
+                self.parser.members.attribute_sender(message)
+            messages.append(message)
+        return messages
+
+    def read_message_arrays(self, start=None, end=None):
+        """The createTime and isSend of this thread's messages (only those
+        from `start` up to `end`, when given), and in group chats their
+        sender ids, as arrays: no Message is created and no content kept.
+        """
+        create_times = []
+        sent = []
+        sender_ids = []
+        is_group_chat = self.is_group_chat
+        message_types = self.parser.message_types
+        for row in self.parser.message_rows(self.contact.raw_username, start, end):
+            if message_types.decode(row['type']) is None:
+                continue
+            create_times.append(row['createTime'])
+            sent.append(bool(row['isSend']))
+            if is_group_chat:
+                sender_ids.append(self.parser.members.sender_id(sent[-1], row['content']))
+        return (numpy.array(create_times, dtype=numpy.int64),
+                numpy.array(sent, dtype=numpy.bool_),
+                numpy.array(sender_ids, dtype=numpy.int32) if is_group_chat else None)
+
     def _parse_messages(self):
-        self._messages = []
-        for row in self.cursor.execute('SELECT createTime, isSend, type, content FROM message WHERE talker=? ORDER BY createTime', [self.contact.raw_username]):
-            try:
-                self._messages.append(Message(row))
-            except UnknownMessageTypeException:
-                pass
+        self._messages = self.read_messages()
+
+
+# Received group messages are stored as `sender:\n` + content
+group_sender_regex = re.compile(r'^([\w@.-]+):\n')
+
+
+class MemberTable(object):
+    """Interns group chat senders as small integers, shared by all threads."""
+
+    SELF = 0
+    UNKNOWN = -1
+
+    def __init__(self, parser):
+        self.parser = parser
+        self.raw_usernames = [parser.own_username]
+        self.member_ids = {}
+        self.lock = threading.Lock()
+
+    def intern(self, raw_username):
+        member_id = self.member_ids.get(raw_username)
+        if member_id is None:
+            with self.lock:
+                member_id = self.member_ids.get(raw_username)
+                if member_id is None:
+                    member_id = self.member_ids[raw_username] = len(self.raw_usernames)
+                    self.raw_usernames.append(raw_username)
+        return member_id
+
+    def contact(self, member_id):
+        raw_username = self.raw_usernames[member_id]
+        return self.parser.contacts.get(raw_username) or Contact([raw_username, None, raw_username])
+
+    def sender_id(self, sent, content):
+        if sent:
+            return self.SELF
+        match = group_sender_regex.match(content or '')
+        return self.intern(match.group(1)) if match else self.UNKNOWN
+
+    def attribute_sender(self, message):
+        message.sender_id = self.sender_id(message.sent, message.content)
+        if message.sender_id > self.SELF:
+            message.content = group_sender_regex.sub('', message.content, count=1)
+
+
+class GroupChat(object):
+
+    def __init__(self, thread, create_times=None, sender_ids=None):
+        # Arrays from Thread.read_message_arrays may stand in for the thread's messages
+        self.thread = thread
+        member_table = thread.parser.members
+        if create_times is None:
+            messages = thread.messages
+            create_times = numpy.fromiter((message.create_time for message in messages), dtype=numpy.int64, count=len(messages))
+            sender_ids = numpy.fromiter((message.sender_id for message in messages), dtype=numpy.int32, count=len(messages))
+        self.create_times = create_times
+        self.sender_ids = sender_ids
+
+        member_ids = set(int(member_id) for member_id in numpy.unique(self.sender_ids[self.sender_ids > MemberTable.SELF]))
+        for raw_username in thread.parser.chatroom_members(thread.contact.raw_username):
+            if raw_username != thread.parser.own_username:
+                member_ids.add(member_table.intern(raw_username))
+        self.members = dict((member_id, member_table.contact(member_id)) for member_id in member_ids)
+
+    def _sender_ids_between(self, start, end):
+        in_period = numpy.ones(len(self.sender_ids), dtype=numpy.bool_)
+        if start is not None:
+            in_period &= self.create_times >= _aware_time_to_milliseconds(start)
+        if end is not None:
+            in_period &= self.create_times < _aware_time_to_milliseconds(end)
+        return self.sender_ids[in_period]
+
+    def count_posts(self, start=None, end=None):
+        """All posts in the group, including our own and those of senders no longer in it."""
+        return len(self._sender_ids_between(start, end))
+
+    def calculate_posts_per_member(self, start=None, end=None):
+        sender_ids = self._sender_ids_between(start, end)
+        counts = numpy.bincount(sender_ids[sender_ids > MemberTable.SELF], minlength=max(self.members.keys() or [0]) + 1)
+        return dict((member_id, int(counts[member_id])) for member_id in self.members)
+
+    def top_posters(self, count, start=None, end=None):
+        posts_per_member = self.calculate_posts_per_member(start, end)
+        # Ties go by username, since member ids depend on which threads were read first
+        top_member_ids = heapq.nsmallest(count, posts_per_member, key=lambda member_id: (-posts_per_member[member_id], self.members[member_id].raw_username))
+        return [(self.members[member_id], posts_per_member[member_id]) for member_id in top_member_ids]
+
+    def lurkers(self, start=None, end=None):
+        posts_per_member = self.calculate_posts_per_member(start, end)
+        return [self.members[member_id] for member_id in posts_per_member if posts_per_member[member_id] == 0]
 
 
 class Contact(object):
@@ -205,17 +421,213 @@ class Contact(object):
         return '<%s %s>' % (self.username, self.display_name_safe)
 
 
+def _message_key(row):
+    # Copies of the same message share createTime, so this only
+    # has to tell apart messages sent within the same millisecond
+    return (row['msgSvrId'] or row['content'], row['isSend'], row['type'])
+
+
+def _talker_message_key(row):
+    # Streams spanning every thread must not mistake the same content sent to
+    # two contacts in the same millisecond (a mass-send) for one message
+    return (row['talker'],) + _message_key(row)
+
+
+def _merge_message_rows(row_streams, message_key=_message_key):
+    """K-way merge of createTime-ordered row streams, dropping duplicates.
+
+    Only the keys seen at the current createTime are remembered, so memory
+    stays flat no matter how much the databases overlap.
+    """
+    sequence = itertools.count()
+    decorated_streams = [((row['createTime'], next(sequence), row) for row in stream) for stream in row_streams]
+    current_time = None
+    seen_keys = set()
+    for create_time, _, row in heapq.merge(*decorated_streams):
+        if create_time != current_time:
+            current_time = create_time
+            seen_keys.clear()
+        key = message_key(row)
+        if key in seen_keys:
+            continue
+        seen_keys.add(key)
+        yield row
+
+
+class ConnectionPool(object):
+    """Read-only connections to one database, one per concurrent user.
+
+    Connections are opened lazily, up to `size`; past that, callers
+    wait for one to be handed back.
+    """
+
+    def __init__(self, filename, size):
+        self.filename = filename
+        self.size = size
+        self.opened = 0
+        self.idle = Queue.Queue()
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.filename, check_same_thread=False)
+        connection.row_factory = sqlite3.Row
+        connection.execute('PRAGMA query_only = ON')
+        return connection
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except Queue.Empty:
+            pass
+        with self.lock:
+            if self.opened < self.size:
+                self.opened += 1
+                return self._connect()
+        return self.idle.get()
+
+    def release(self, connection):
+        self.idle.put(connection)
+
+
 class Parser(object):
 
-    def __init__(self, filename):
+    # Knuth's multiplicative hash of createTime, for picking a reproducible
+    # sample. createTime (unlike rowid) is the same in every copy of a
+    # message, so merged databases agree on which copies are sampled.
+    SAMPLE_HASH = '(((createTime % 1000003) * 2654435761) % 4294967296)'
+
+    def __init__(self, filename, merge_filenames=(), sample_rate=None, only_types=None, pool_size=4):
         self.filename = filename
-        self.database_handle = sqlite3.connect(self.filename)
-        self.database_handle.row_factory = sqlite3.Row
+        self.sample_rate = sample_rate
+        self.message_types = MessageTypeRegistry.initialize()
+        # Raw codes to fetch, when callers only need some TYPE_*s
+        self.only_raw_types = self.message_types.raw_types_for(only_types) if only_types is not None else None
+        self.filenames = [filename] + list(merge_filenames)
+        self.database_handles = []
+        for database_filename in self.filenames:
+            database_handle = sqlite3.connect(database_filename)
+            database_handle.row_factory = sqlite3.Row
+            self.database_handles.append(database_handle)
+        self.database_handle = self.database_handles[0]
         self.cursor = self.database_handle.cursor()
-        self.threads = [Thread(self.cursor, contact) for contact in self._parse_contacts()]
+        # Thread loading gets its own connections, so threads can
+        # load concurrently without trampling the shared cursor
+        self.pools = [ConnectionPool(database_filename, pool_size) for database_filename in self.filenames]
+        self.own_username = self._parse_own_username()
+        self.members = MemberTable(self)
+        self.threads = [Thread(self, contact) for contact in self._parse_contacts()]
+        self.contacts = dict((thread.contact.raw_username, thread.contact) for thread in self.threads)
+
+    def _parse_own_username(self):
+        # userinfo id 2 holds the logged-in account's username
+        try:
+            row = self.cursor.execute('SELECT value FROM userinfo WHERE id=2').fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return row[0] if row else None
 
     def _parse_contacts(self):
-        return [Contact(row) for row in self.cursor.execute('SELECT username, alias, nickname FROM rcontact')]
+        # Resolve contacts across databases by username; earlier
+        # databases win, later ones only fill in missing fields
+        merged_columns = collections.OrderedDict()
+        for database_handle in self.database_handles:
+            for row in database_handle.execute('SELECT username, alias, nickname FROM rcontact'):
+                columns = merged_columns.setdefault(row[0], list(row))
+                for i in xrange(1, len(columns)):
+                    columns[i] = columns[i] or row[i]
+        return [Contact(columns) for columns in merged_columns.values()]
+
+    def chatroom_members(self, raw_username):
+        raw_usernames = []
+        # Pooled connections, since group chats may load on worker threads
+        for pool in self.pools:
+            connection = pool.acquire()
+            try:
+                rows = connection.execute('SELECT memberlist FROM chatroom WHERE chatroomname=?', [raw_username]).fetchall()
+            except sqlite3.OperationalError:
+                continue
+            finally:
+                pool.release(connection)
+            for row in rows:
+                for member in (row[0] or '').split(';'):
+                    if member and member not in raw_usernames:
+                        raw_usernames.append(member)
+        return raw_usernames
+
+    def _message_filters(self):
+        clauses = []
+        arguments = []
+        if self.only_raw_types is not None:
+            clauses.append('type IN (%s)' % ', '.join(['?'] * len(self.only_raw_types)))
+            arguments.extend(self.only_raw_types)
+        if self.sample_rate is not None:
+            clauses.append('%s < ?' % self.SAMPLE_HASH)
+            arguments.append(int(self.sample_rate * 4294967296))
+        return clauses, arguments
+
+    def message_rows(self, raw_username, start=None, end=None):
+        clauses, arguments = self._message_filters()
+        period_clauses, period_arguments = _period_filters(start, end)
+        query = 'SELECT createTime, msgSvrId, isSend, type, content FROM message WHERE %s ORDER BY createTime' % ' AND '.join(['talker=?'] + period_clauses + clauses)
+        return self._execute_merged(query, [raw_username] + period_arguments + arguments)
+
+    def all_message_rows(self, start, end):
+        """Every message row from `start` up to `end`, across all threads,
+        read lazily so that nothing but the current row is held in memory.
+        """
+        clauses, arguments = self._message_filters()
+        period_clauses, period_arguments = _period_filters(start, end)
+        if len(self.pools) == 1:
+            # Nothing to deduplicate, so no need to sort either
+            query = 'SELECT talker, createTime, isSend, type FROM message WHERE %s'
+        else:
+            query = 'SELECT talker, createTime, msgSvrId, isSend, type, content FROM message WHERE %s ORDER BY createTime'
+        query = query % ' AND '.join(period_clauses + clauses)
+        return self._execute_merged(query, period_arguments + arguments, _talker_message_key)
+
+    def skipped_message_counts(self, start, end):
+        """How many messages from `start` up to `end` each message.type
+        westats does not recognize accounts for, as a Counter, across the
+        threads of every database.
+        """
+        known_raw_types = sorted(self.message_types.raw_types)
+        clauses, arguments = self._message_filters()
+        period_clauses, period_arguments = _period_filters(start, end)
+        clauses = ['type NOT IN (%s)' % ', '.join(['?'] * len(known_raw_types))] + period_clauses + clauses
+        arguments = known_raw_types + period_arguments + arguments
+        if len(self.pools) == 1:
+            query = 'SELECT talker, type FROM message WHERE %s'
+        else:
+            query = 'SELECT talker, createTime, msgSvrId, isSend, type, content FROM message WHERE %s ORDER BY createTime'
+        skipped_counts = collections.Counter()
+        for row in self._execute_merged(query % ' AND '.join(clauses), arguments, _talker_message_key):
+            if row['talker'] in self.contacts:
+                skipped_counts[row['type']] += 1
+        return skipped_counts
+
+    def _execute_merged(self, query, arguments, message_key=_message_key):
+        connections = [pool.acquire() for pool in self.pools]
+        try:
+            if len(connections) == 1:
+                rows = connections[0].execute(query, arguments)
+            else:
+                rows = _merge_message_rows([connection.execute(query, arguments) for connection in connections], message_key)
+            for row in rows:
+                yield row
+        finally:
+            for pool, connection in zip(self.pools, connections):
+                pool.release(connection)
+
+    def prefetch(self, threads, workers=4):
+        """Load the messages of `threads` in parallel, e.g. just the few
+        threads a tool is about to look at.
+        """
+        worker_pool = ThreadPool(workers)
+        try:
+            worker_pool.map(lambda thread: thread.messages, threads)
+        finally:
+            worker_pool.close()
+            worker_pool.join()
 
     def get_thread_with_raw_username(self, raw_username):
         return _find_exactly_one(self.threads, lambda thread: raw_username == thread.contact.raw_username)
@@ -0,0 +1,113 @@
+import os
+import re
+import sqlite3
+
+from wxparser import Message, group_sender_regex, _message_key, _period_filters
+
+# Wildcards (and the escape character itself) in a LIKE pattern
+like_escape_regex = re.compile(r'[\\%_]')
+
+
+class SearchIndex(object):
+    """Full-text index of text messages, kept in a sidecar SQLite database.
+
+    Uses the FTS5 trigram tokenizer (SQLite 3.34+), which matches any
+    substring of three characters or more and so works for Chinese without
+    word segmentation. Shorter terms fall back to a LIKE scan of the index.
+    Messages are deduplicated across merged databases the same way
+    `Parser` does, and `update` only reads rows added since the last call.
+    """
+
+    BATCH_SIZE = 10000
+
+    def __init__(self, parser, filename=None):
+        self.parser = parser
+        self.filename = filename or parser.filename + '.fts'
+        self.connection = sqlite3.connect(self.filename)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS indexed_source (
+                filename TEXT PRIMARY KEY,
+                last_rowid INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS indexed_message (
+                id INTEGER PRIMARY KEY,
+                talker TEXT NOT NULL,
+                createTime INTEGER NOT NULL,
+                isSend INTEGER NOT NULL,
+                dedupe_key NOT NULL,
+                content TEXT NOT NULL,
+                UNIQUE (talker, createTime, isSend, dedupe_key)
+            );
+            CREATE INDEX IF NOT EXISTS indexed_message_talker ON indexed_message (talker, createTime);
+            CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5(
+                content,
+                content='indexed_message',
+                content_rowid='id',
+                tokenize='trigram'
+            );
+            CREATE TRIGGER IF NOT EXISTS indexed_message_insert AFTER INSERT ON indexed_message BEGIN
+                INSERT INTO message_fts (rowid, content) VALUES (new.id, new.content);
+            END;
+        ''')
+
+    def update(self):
+        """Index text messages added to any of the parser's databases since the last update."""
+        # Only plain text messages have searchable content
+        text_raw_types = self.parser.message_types.raw_types_for([Message.TYPE_NORMAL])
+        for source_filename, database_handle in zip(self.parser.filenames, self.parser.database_handles):
+            source_key = os.path.abspath(source_filename)
+            last_rowid = self.connection.execute('SELECT last_rowid FROM indexed_source WHERE filename=?', [source_key]).fetchone()
+            last_rowid = last_rowid[0] if last_rowid else 0
+            source_cursor = database_handle.execute('SELECT rowid AS source_rowid, talker, createTime, msgSvrId, isSend, type, content FROM message WHERE rowid>? AND type IN (%s) ORDER BY rowid' % ', '.join(['?'] * len(text_raw_types)),
+                                                    [last_rowid] + text_raw_types)
+            while True:
+                rows = source_cursor.fetchmany(self.BATCH_SIZE)
+                if not rows:
+                    break
+                self.connection.executemany('INSERT OR IGNORE INTO indexed_message (talker, createTime, isSend, dedupe_key, content) VALUES (?, ?, ?, ?, ?)',
+                                            [(row['talker'], row['createTime'], row['isSend'], _message_key(row)[0], _searchable_content(row)) for row in rows])
+                last_rowid = rows[-1]['source_rowid']
+            self.connection.execute('INSERT OR REPLACE INTO indexed_source (filename, last_rowid) VALUES (?, ?)', [source_key, last_rowid])
+            self.connection.commit()
+
+    def _where(self, term, talkers=None, sent=None, start=None, end=None):
+        if len(term) >= 3:
+            clauses = ['indexed_message.id IN (SELECT rowid FROM message_fts WHERE message_fts MATCH ?)']
+            arguments = ['"%s"' % term.replace('"', '""')]
+        else:
+            clauses = ["indexed_message.content LIKE ? ESCAPE '\\'"]
+            arguments = ['%%%s%%' % like_escape_regex.sub(r'\\\g<0>', term)]
+        if talkers is not None:
+            talkers = list(talkers)
+            clauses.append('talker IN (%s)' % ', '.join(['?'] * len(talkers)))
+            arguments.extend(talkers)
+        if sent is not None:
+            clauses.append('isSend=?')
+            arguments.append(1 if sent else 0)
+        period_clauses, period_arguments = _period_filters(start, end)
+        clauses.extend(period_clauses)
+        arguments.extend(period_arguments)
+        return ' AND '.join(clauses), arguments
+
+    def count(self, term, talkers=None, sent=None, start=None, end=None):
+        """Number of text messages containing `term` (a word or phrase)."""
+        where, arguments = self._where(term, talkers, sent, start, end)
+        return self.connection.execute('SELECT COUNT(*) FROM indexed_message WHERE ' + where, arguments).fetchone()[0]
+
+    def counts_by_talker(self, term, talkers=None, sent=None, start=None, end=None):
+        where, arguments = self._where(term, talkers, sent, start, end)
+        return dict(self.connection.execute('SELECT talker, COUNT(*) FROM indexed_message WHERE ' + where + ' GROUP BY talker', arguments))
+
+    def monthly_counts(self, term, start, end, talkers=None, sent=None):
+        """Messages containing `term` per calendar month from `start` up to `end`,
+        in the timezone of `start`. Returns a {'YYYY-MM': count} dict.
+        """
+        where, arguments = self._where(term, talkers, sent, start, end)
+        offset_seconds = int(start.utcoffset().total_seconds())
+        return dict(self.connection.execute("SELECT strftime('%Y-%m', createTime / 1000 + ?, 'unixepoch') AS month, COUNT(*) FROM indexed_message WHERE " + where + ' GROUP BY month',
+                                            [offset_seconds] + arguments))
+
+
+def _searchable_content(row):
+    # Received group messages carry a `sender:\n` prefix
+    return group_sender_regex.sub('', row['content'] or '', count=1)